@@ -1,7 +1,14 @@
 import re
+import io
+import itertools
 import copy
 import math
+import json
+import struct
 import datetime as dt
+from collections.abc import MutableMapping
+
+import numpy as np
 
 # Should I have mutual dependencies between baltic3 and baltic3_utils?
 import baltic3 as btu
@@ -12,9 +19,25 @@ def unique(o, idfun=repr):
     return [seen.setdefault(idfun(e),e) for e in o if idfun(e) not in seen]
 
 
+def descendant_names(k):
+    """ Sorted list of unique names of all tips (and collapsed clades) descended from node k. """
+    names=set()
+    stack=list(k.children)
+    while len(stack)>0:
+        w=stack.pop()
+        if w.branchType=='leaf':
+            names.add(w.numName)
+        elif w._leaves is not None: ## reuse a descendant's list if it has already been made
+            names.update(w._leaves)
+        else:
+            stack+=w.children
+    return sorted(names)
+
 class clade: ## clade class
+    branchType='leaf' ## clade class poses as a leaf
+    __slots__=('subtree','length','height','absoluteTime','parent','traits','index','name','numName','leaves',
+               'x','y','lastHeight','lastAbsoluteTime','width')
     def __init__(self,givenName):
-        self.branchType='leaf' ## clade class poses as a leaf
         self.subtree=None ## subtree will contain all the branches that were collapsed
         self.length=0.0
         self.height=None
@@ -32,8 +55,9 @@ class clade: ## clade class
         self.width=1
 
 class node: ## node class
+    branchType='node'
+    __slots__=('length','height','absoluteTime','parent','children','traits','index','childHeight','numChildren','x','y','_leaves')
     def __init__(self):
-        self.branchType='node'
         self.length=0.0 ## branch length, recovered from string
         self.height=None ## height, set by traversing the tree, which adds up branch lengths along the way
         self.absoluteTime=None ## branch end point in absolute time, once calibrations are done
@@ -45,12 +69,25 @@ class node: ## node class
         self.numChildren=0 ## number of tips that eventually descend from this node
         self.x=None ## X and Y coordinates of this node, once drawTree() is called
         self.y=None
-        ## contains references to all tips of this node
-        self.leaves=[] ## is a sorted list of all tips that eventually descend from it
+        self._leaves=None ## names of all descendant tips, only made when leaves is first asked for
+
+    @property
+    def leaves(self):
+        """ Sorted list of names of all tips that eventually descend from this node.
+        Made on first request and kept until the next tree traversal. tree.tipsOf and tree.isDescendant
+        answer the same questions from one pre-order index without keeping a list at every node. """
+        if self._leaves is None:
+            self._leaves=descendant_names(self)
+        return self._leaves
+
+    @leaves.setter
+    def leaves(self,value):
+        self._leaves=value
 
 class leaf: ## leaf class
+    branchType='leaf'
+    __slots__=('name','numName','index','length','absoluteTime','height','parent','traits','x','y')
     def __init__(self):
-        self.branchType='leaf'
         self.name=None ## name of tip after translation, since BEAST trees will generally have numbers for taxa but will provide a map at the beginning of the file
         self.numName=None ## the original name of the taxon, would be an integer if coming from BEAST, otherwise can be actual name
         self.index=None ## index of the character that defines this object, will be a unique ID for each object in the tree
@@ -62,8 +99,226 @@ class leaf: ## leaf class
         self.x=None ## position of tip on x axis if the tip were to be plotted
         self.y=None ## position of tip on y axis if the tip were to be plotted
 
+class lcaIndex: ## answers most recent common ancestor queries on a fixed topology, see tree.getLCAIndex()
+    def __init__(self,root):
+        """
+        Lays branches out in pre-order and builds a range-minimum sparse table over their depths.
+        For branches a and b (a before b in pre-order, a!=b) the common ancestor is the parent of
+        the shallowest branch in positions (a,b], which is the Euler tour reduction without repeated entries.
+        """
+        self.order=[] ## branches in pre-order, root first
+        depth=[]
+        stack=[(root,0)]
+        while len(stack)>0:
+            k,d=stack.pop()
+            self.order.append(k)
+            depth.append(d)
+            if k.branchType=='node':
+                stack+=[(ch,d+1) for ch in reversed(k.children)]
+
+        self.position={k:i for i,k in enumerate(self.order)} ## branch object to pre-order position
+        self.name={} ## tip name to pre-order position
+        self.numName={} ## tip numName to pre-order position
+        for i,k in enumerate(self.order):
+            if k.branchType=='leaf':
+                self.name[k.name]=i
+                self.numName[k.numName]=i
+
+        end=[len(depth)]*len(depth) ## subtree of the branch at position i is order[i:end[i]]
+        unfinished=[]
+        for i,d in enumerate(depth):
+            while len(unfinished)>0 and depth[unfinished[-1]]>=d: ## subtree ends where the next branch at least as shallow begins
+                end[unfinished.pop()]=i
+            unfinished.append(i)
+        self.end=np.array(end,dtype=np.int64)
+        self.tips=[k for k in self.order if k.branchType=='leaf'] ## tips in pre-order, the tips of every branch are a contiguous run of them
+        tipsBefore=np.concatenate([[0],np.cumsum([k.branchType=='leaf' for k in self.order])]).astype(np.int64) ## number of tips before each position
+        self.tipStart=tipsBefore[:-1] ## tips of the branch at position i are tips[tipStart[i]:tipEnd[i]]
+        self.tipEnd=tipsBefore[self.end]
+
+        self.depth=np.array(depth,dtype=np.int32)
+        self.table=[np.arange(len(depth),dtype=np.int32)] ## table[j][i] is the shallowest position in [i,i+2**j)
+        span=1
+        while span*2<=len(depth):
+            prev=self.table[-1]
+            left=prev[:len(depth)-span*2+1]
+            right=prev[span:span+len(left)]
+            self.table.append(np.where(self.depth[left]<=self.depth[right],left,right))
+            span*=2
+
+    def __len__(self):
+        return len(self.order)
+
+    def shallowest(self,i,j):
+        """ Position of the shallowest branch between pre-order positions i and j (inclusive, i<=j). """
+        level=(j-i+1).bit_length()-1
+        a=self.table[level][i]
+        b=self.table[level][j-(1<<level)+1]
+        if self.depth[a]<=self.depth[b]:
+            return int(a)
+        return int(b)
+
+    def mrcaPosition(self,i,j):
+        """ Pre-order position of the common ancestor of branches at positions i and j. """
+        if i==j:
+            return i
+        if i>j:
+            i,j=j,i
+        return self.position[self.order[self.shallowest(i+1,j)].parent]
+
+    def mrca(self,a,b):
+        """ Most recent common ancestor of two branch objects, O(1). A branch is its own ancestor. """
+        return self.order[self.mrcaPosition(self.position[a],self.position[b])]
+
+    def tipsOf(self,k):
+        """ Tips descended from branch k (k itself if it is a tip), in pre-order. A slice of tips, no traversal. """
+        i=self.position[k]
+        return self.tips[self.tipStart[i]:self.tipEnd[i]]
+
+    def numTipsOf(self,k):
+        """ Number of tips descended from branch k, O(1). """
+        i=self.position[k]
+        return int(self.tipEnd[i]-self.tipStart[i])
+
+    def isDescendant(self,k,ancestor):
+        """ Whether branch k descends from branch ancestor, O(1). A branch descends from itself. """
+        i=self.position[ancestor]
+        return bool(i<=self.position[k]<self.end[i])
+
+    def mrcaOf(self,positions):
+        """
+        Most recent common ancestor of branches at the given pre-order positions, O(k).
+        The ancestor of a set is the ancestor of its first and last members in pre-order.
+        """
+        positions=list(positions)
+        assert len(positions)>0,'No branches given'
+        return self.order[self.mrcaPosition(min(positions),max(positions))]
+
+def _preorder(k):
+    """ Branches of the subtree starting at k, in pre-order. """
+    order=[]
+    stack=[k]
+    while len(stack)>0:
+        k=stack.pop()
+        order.append(k)
+        if k.branchType=='node':
+            stack+=k.children[::-1]
+    return order
+
+def _count_tips(k):
+    """ Set the number of tips below node k and the height of the most recent one (childHeight) from its children. """
+    k.numChildren=0
+    k.childHeight=0
+    for ch in k.children:
+        if ch.branchType=='leaf':
+            k.numChildren+=1
+            if k.childHeight<=ch.height:
+                k.childHeight=ch.height
+        else:
+            k.numChildren+=ch.numChildren
+            if k.childHeight<=ch.childHeight:
+                k.childHeight=ch.childHeight
+
+def _sort_children(k,descending=True):
+    """ Sort children of node k as sortBranches does - leaves and nodes separately, nodes by number of tips and then by length. """
+    modifier=-1 if descending==True else 1
+    ## split node's offspring into nodes and leaves, sort each list individually
+    nodes=sorted([x for x in k.children if x.branchType=='node'],key=lambda q:(-q.numChildren*modifier,q.length*modifier))
+    leaves=sorted([x for x in k.children if x.branchType=='leaf'],key=lambda q:q.length*modifier)
+    if modifier==1: ## if sorting one way - nodes come first, leaves later
+        k.children=nodes+leaves
+    else: ## otherwise sort the other way
+        k.children=leaves+nodes
+
+def _skip(k):
+    """ Vertical space taken up by a tip when drawn, collapsed clades take up their width. """
+    return 1 if isinstance(k,leaf) else k.width+1
+
+def _drawn_extent(k):
+    """
+    Vertical space taken up by the tips of the subtree starting at k, and by all tips drawn after them, read off their current y coordinates.
+    Returns None if the subtree hasn't been drawn.
+    """
+    first=k
+    while first.branchType=='node' and len(first.children)>0:
+        first=first.children[0]
+    last=k
+    while last.branchType=='node' and len(last.children)>0:
+        last=last.children[-1]
+    if first.branchType=='node' or first.y is None or last.y is None:
+        return None
+    end=last.y-_skip(last)
+    if isinstance(last,clade):
+        end+=_skip(last)/2.0
+    span=first.y-end
+    if isinstance(first,clade):
+        span+=_skip(first)/2.0
+    return span,end
+
+def _draw_subtree(k,end):
+    """
+    Find x and y coordinates of every branch in the subtree starting at k, as drawTree would for a tree whose tips after this subtree take up end.
+    Returns the vertical space taken up by the subtree's tips. Branches without a parent (the root) are left without coordinates, as in drawTree.
+    """
+    order=_preorder(k)
+    span={}
+    for w in reversed(order):
+        if w.branchType=='leaf':
+            span[w]=_skip(w)
+        else:
+            span[w]=sum([span[ch] for ch in w.children])
+    ends={k:end}
+    for w in order:
+        if w.branchType=='leaf':
+            w.y=ends[w]+span[w]
+            if isinstance(w,clade): ## if dealing with collapsed clade - adjust y position to be in the middle of the skip
+                w.y-=span[w]/2.0
+            w.x=w.height
+        else:
+            e=ends[w]
+            for ch in reversed(w.children): ## tips are stacked from the last one upwards
+                ends[ch]=e
+                e+=span[ch]
+    for w in reversed(order):
+        if w.branchType=='node' and w.parent is not None and len(w.children)>0:
+            w.y=sum([ch.y for ch in w.children])/float(len(w.children)) ## internal branch is in the middle of the vertical bar
+            w.x=w.height
+    return span[k]
+
+def _shift_subtree(k,delta):
+    """ Move every branch of the subtree starting at k by delta along the y axis. """
+    stack=[k]
+    while len(stack)>0:
+        w=stack.pop()
+        if w.y is not None:
+            w.y+=delta
+        if w.branchType=='node':
+            stack+=w.children
+
+def _derived_property(name,rebuild=None):
+    """
+    Property of a tree that brings data derived from the branches up to date (see tree.update) before returning the value stored under name.
+    If rebuild is given the value is remade with it whenever it's None.
+    """
+    def fget(self):
+        if len(self.dirty)>0:
+            self.update()
+        if rebuild is not None and getattr(self,name) is None:
+            setattr(self,name,rebuild(self))
+        return getattr(self,name)
+    def fset(self,value):
+        setattr(self,name,value)
+    return property(fget,fset)
+
 class tree: ## tree class
+    Objects=_derived_property('_Objects') ## flat list of all branches in the tree
+    nodes=_derived_property('_nodes',lambda self:[k for k in self._Objects if isinstance(k,node)]) ## node objects in tree
+    leaves=_derived_property('_leaves',lambda self:[k for k in self._Objects if isinstance(k,leaf)]) ## leaf objects in tree
+    treeHeight=_derived_property('_treeHeight') ## distance between the root and the most recent tip
+    ySpan=_derived_property('_ySpan') ## vertical space taken up by tips when drawn
+
     def __init__(self):
+        self.dirty={} ## branches changed since derived data was last computed, see markDirty()
         self.cur_node=node() ## current node is a new instance of a node class
         self.cur_node.index='Root' ## first object in the tree is the root to which the rest gets attached
         self.cur_node.length=0.0 ## startind node branch length is 0
@@ -75,6 +330,10 @@ class tree: ## tree class
         self.tipMap=None
         self.treeHeight=0 ## tree height is the distance between the root and the most recent tip
         self.ySpan=0.0
+        self.lca=None ## most recent common ancestor index, built on request by getLCAIndex()
+        self.lookup=None ## name, numName and index dictionaries, built on request by getLookup()
+        self.sorting=None ## order branches are kept sorted in once sortBranches() has been called, None if they aren't
+        self.drawn=False ## whether x and y coordinates follow the order of the tree, as drawTree() leaves them
 
     def add_node(self,i):
         """ Attaches a new node to current node. """
@@ -83,8 +342,8 @@ class tree: ## tree class
         new_node.parent=self.cur_node ## new node's parent is current node
         self.cur_node.children.append(new_node) ## new node is a child of current node
         self.cur_node=new_node ## current node is now new node
-        self.Objects.append(self.cur_node) ## add new node to list of objects in the tree
-        self.nodes.append(self.cur_node)
+        self._Objects.append(self.cur_node) ## add new node to list of objects in the tree
+        self._nodes.append(self.cur_node)
 
 
     def add_leaf(self,i,name):
@@ -95,65 +354,68 @@ class tree: ## tree class
         new_leaf.parent=self.cur_node ## leaf's parent is current node
         self.cur_node.children.append(new_leaf) ## assign leaf to parent's children
         self.cur_node=new_leaf ## current node is now new leaf
-        self.Objects.append(self.cur_node) ## add leaf to all objects in the tree
-        self.leaves.append(self.cur_node)
+        self._Objects.append(self.cur_node) ## add leaf to all objects in the tree
+        self._leaves.append(self.cur_node)
 
-    def subtree(self,k=None,subtree=[],traitName=None,converterDict=None):
+    def subtree(self,k=None,subtree=[],traitName=None,converterDict=None,view=False):
         """ Generate a subtree (as a baltic tree object) from a traversal.
         If a trait name is provided the traversal occurs within the trait value of the starting node.
         Note - trait-specific traversal can result in multitype trees.
-        If this is undesired call singleType() on the resulting subtree afterwards. """
+        If this is undesired call singleType() on the resulting subtree afterwards.
+        Only the branches in the subtree are copied, see copyBranches for view. """
         if len(subtree)==0:
             if traitName:
-                subtree=copy.deepcopy(self.traverseWithinTrait(k,traitName,converterDict))
+                subtree=self.traverseWithinTrait(k,traitName,converterDict)
             else:
-                subtree=copy.deepcopy(self.traverse_tree(k,include_all=True))
-        else:
-            subtree=copy.deepcopy(subtree)
+                subtree=self.traverse_tree(k,include_all=True)
 
         if subtree is None or [w.branchType=='leaf' for w in subtree].count(True)==0:
             return None
         else:
+            copies=self.copyBranches(subtree,view=view) ## children outside the subtree are left out of the copies
             local_tree=tree() ## create a new tree object where the subtree will be
-            local_tree.Objects=subtree ## assign branches to new tree object
-            local_tree.root.children.append(subtree[0]) ## connect tree object's root with subtree
-            subtree[0].parent=local_tree.root ## subtree's root's parent is tree object's root
-            local_tree.root.absoluteTime=subtree[0].absoluteTime-subtree[0].length ## root's absolute time is subtree's root time
+            local_tree.Objects=[copies[w] for w in subtree] ## assign branches to new tree object
+            top=local_tree.Objects[0]
+            local_tree.root.children.append(top) ## connect tree object's root with subtree
+            top.parent=local_tree.root ## subtree's root's parent is tree object's root
+            local_tree.root.absoluteTime=top.absoluteTime-top.length ## root's absolute time is subtree's root time
 
             if traitName: ## relying on within-trait traversal
-                for nd in local_tree.Objects:
-                    if nd.branchType=='node':
-                        nd.children=[ch for ch in nd.children if ch in subtree] ## prune each node's children down to branches that were present in the traversal
-                hangingNodes=[h for h in local_tree.Objects if h.branchType=='node' and len(h.children)==0] ## check for nodes without any children (hanging nodes)
-                while len(hangingNodes)>0:
-                    for h in sorted(hangingNodes,key=lambda x:-x.height):
-                        h.parent.children.remove(h) ## remove old parent from grandparent's children
-                        hangingNodes.remove(h) ## remove old parent from multitype nodes
-                        local_tree.Objects.remove(h) ## remove old parent from all objects
-                    hangingNodes=[h for h in local_tree.Objects if h.branchType=='node' and len(h.children)==0]
-
-            local_tree.sortBranches() ## sort branches, draw small tree
+                hangingNodes=set() ## nodes left without any children (hanging nodes), checked children first so that they cascade upwards
+                for h in reversed(local_tree.Objects):
+                    if h.branchType=='node' and len([ch for ch in h.children if ch not in hangingNodes])==0:
+                        hangingNodes.add(h)
+                for h in hangingNodes:
+                    h.parent.children.remove(h) ## remove hanging node from its parent's children
+                local_tree.Objects=[w for w in local_tree.Objects if w not in hangingNodes]
+
+            local_tree.markDirty(local_tree.root,subtree=True,sort=True) ## sort branches, draw small tree once it's looked at
             return local_tree
 
     def singleType(self):
-        """ Removes any branches with a single child (multitype nodes). """
+        """ Removes any branches with a single child (multitype nodes), in a single pass - chains of them are spliced into the branch below. """
         multiTypeNodes=[k for k in self.Objects if k.branchType=='node' and len(k.children)==1]
-        while len(multiTypeNodes)>0:
-            multiTypeNodes=[k for k in self.Objects if k.branchType=='node' and len(k.children)==1]
-            for k in sorted(multiTypeNodes,key=lambda x:-x.height):
-                child=k.children[0] ## fetch child
-                grandparent=k.parent ## fetch grandparent
-
-                child.parent=grandparent ## child's parent is now grandparent
-
-                grandparent.children.append(child) ## add child to grandparent's children
-                grandparent.children.remove(k) ## remove old parent from grandparent's children
-
-                child.length+=k.length ## adjust child length
-
-                multiTypeNodes.remove(k) ## remove old parent from multitype nodes
-                self.Objects.remove(k) ## remove old parent from all objects
-        self.sortBranches()
+        children={} ## children of nodes that gain or lose children, as dictionaries so that they can be removed and appended cheaply in order
+        spliced=[]
+        for k in sorted(multiTypeNodes,key=lambda x:-x.height):
+            child=next(iter(children.pop(k) if k in children else k.children)) ## fetch child
+            grandparent=k.parent ## fetch grandparent
+
+            child.parent=grandparent ## child's parent is now grandparent
+
+            if grandparent not in children:
+                children[grandparent]=dict.fromkeys(grandparent.children)
+            children[grandparent][child]=None ## add child to grandparent's children
+            del children[grandparent][k] ## remove old parent from grandparent's children
+
+            child.length+=k.length ## adjust child length
+            spliced.append(child)
+        for k,kids in children.items():
+            k.children=list(kids)
+        removed=set(multiTypeNodes)
+        self.Objects=[k for k in self.Objects if k not in removed] ## remove old parents from all objects
+        for k in spliced:
+            self.markDirty(k,sort=True)
 
     def setAbsoluteTime(self,date):
         """ place all objects in absolute time by providing the date of the most recent tip """
@@ -201,124 +463,192 @@ class tree: ## tree class
     def traverse_tree(self,startNode=None,include_all=False,verbose=False):
         """ Traverses tree from root. If a starting node is not defined begin traversal from root.
         By default returns a list of leaf objects that have been visited,
-        optionally returns a list of all objects in the tree. """
+        optionally returns a list of all objects in the tree.
+        Single iterative pass - heights (parent's height plus branch length) are set on the way down, numbers of tips on the way back up. """
         if startNode==None: ## if no starting point defined - start from root
-            cur_node=self.root
-            start=None ## remember that traversal was started from scratch
-            startNode=cur_node
+            startNode=self.root
         elif startNode.branchType=='leaf':
-            start=startNode
             if include_all==True:
                 return [startNode]
             else:
                 return [startNode.numName]
-        else:
-            start=startNode
-            cur_node=startNode ## otherwise start from starting node
 
         self.leaves=[k for k in self.Objects if isinstance(k,leaf)]
         self.nodes=[k for k in self.Objects if isinstance(k,node)]
+        self.lca=None ## topology may have changed since the index was built
+        self.lookup=None
 
         if verbose==True:
             print('Verbose traversal initiated')
 
-        for k in self.Objects: ## reset leaves and number of children for every node
-            if isinstance(k,node):
-                k.leaves=[]
-                k.numChildren=0
-
-        seen=[] ## remember what's been visited
         collected=[] ## collect leaf objects along the way
         maxHeight=0 ## check what the maximum distance between the root and the most recent tip is
-        if startNode!=None and startNode.height!=None:
-            height=startNode.height
-        else:
-            height=0.0 ## begin at height 0.0
+        if startNode.height==None:
+            startNode.height=0.0 ## begin at height 0.0
+        startNode.leaves=None ## forget list of descendant tips and reset number of children
+        startNode.numChildren=0
 
-        root=False ## root becomes true once you're unable to go back any further
-
-        while root==False: ## cycle indefinitely as long as there's more of the tree to explore
-            if seen.count(cur_node.index)>3:
-                if verbose==True:
-                    print('node %s seen too many times, breaking'%(cur_node.index))
-                root=True
-                break
+        if include_all==True:
+            collected.append(startNode)
 
-            if cur_node.branchType=='node': ## if currently dealing with a node
-                if verbose==True:
-                    print('encountered node %s'%(cur_node.index))
-                if include_all==True: ## if node hasn't been collected and we want to collect all objects - add it for reporting later
-                    collected.append(cur_node)
-                # check whether all children of the node have been seen ,
-                # or whether we're not currently at the root
-                # as long as all children have been seen will descend downwards
-                while sum([1 if x.index in seen else 0 for x in cur_node.children])==len(cur_node.children) and cur_node!=startNode.parent:
-                    if verbose==True:
-                        print('seen all children of node %s'%(cur_node.index))
-
-                    # New necessary logical modification for py3
-                    # Inits at None; must be overriden to 0 at the leaves
-                    if cur_node.childHeight is None:
-                        cur_node.childHeight = 0
-
-                    ## check whether current node's most recent child is higher than the known highest point in the tree
-                    if cur_node.childHeight <= highestTip:
-                        cur_node.childHeight = highestTip
-                    elif cur_node.childHeight > highestTip:
-                        highestTip = cur_node.childHeight
-
-                    if cur_node.index==startNode.index: ## if currently at root - set the root flag to True and break the while loop
-                        if verbose==True:
-                            print('reached starting point %s'%(cur_node.index))
-                        cur_node.height=height
-                        root=True
-                        break
-                    else: ## otherwise...
-                        if verbose==True:
-                            print('heading to parent of %s'%(cur_node.index))
-                        cur_node.parent.numChildren+=cur_node.numChildren ## add the number of current node's children to its parent
-                        cur_node.parent.leaves+=cur_node.leaves ## add the list of tip names descended from current node to its parent
-                        cur_node.parent.leaves=unique(cur_node.parent.leaves) ## reduce to only unique names
-                        cur_node.parent.leaves=sorted(cur_node.parent.leaves) ## sort children
-                        cur_node.height=height ## set height
-                        height-=float(cur_node.length) ## prepare height value for the eventual descent downwards in the tree
-                        cur_node=cur_node.parent ## current node is now current node's parent
-
-                last_seen=[1 if x.index in seen else 0 for x in cur_node.children] ## put 1 for every child of the node that you have seen, 0 for every one that hasn't been seen
-
-                try: ## try finding the first unvisited child of a node
-                    idx_to_visit=last_seen.index(0)
-                except ValueError:
-                    idx_to_visit=0 ## no children seen yet
+        stack=[[startNode,0]] ## nodes on the path from the starting node, with the position of the next child to visit
+        while len(stack)>0:
+            frame=stack[-1]
+            cur_node=frame[0]
 
+            if frame[1]<len(cur_node.children): ## there are unvisited children - head towards the next one
+                child=cur_node.children[frame[1]]
+                frame[1]+=1
                 if verbose==True:
-                    print('visiting %s next (child of %s)'%(cur_node.children[idx_to_visit].index,cur_node.index))
-
-                cur_node.height=height ## set height of current node
-                height+=float(cur_node.children[idx_to_visit].length) ## prepare for heading towards the previously unvisited child branch
-                cur_node=cur_node.children[idx_to_visit] ## set current node to unvisited child
-                seen.append(cur_node.index) ## remember that the child has now been visited
+                    print('visiting %s next (child of %s)'%(child.index,cur_node.index))
+                child.height=cur_node.height+float(child.length) ## set height of the previously unvisited child branch
 
-            elif cur_node.branchType=='leaf': ## node dealing with node, are we dealing with a leaf (tip)?
+                if child.branchType=='leaf':
+                    if verbose==True:
+                        print('encountered leaf %s (%s or %s)'%(child.index,child.numName,child.name))
+                    collected.append(child)
+                    if maxHeight<=float(child.height): ## is this the highest point we've seen in the tree so far?
+                        maxHeight=float(child.height)
+                else:
+                    if verbose==True:
+                        print('encountered node %s'%(child.index))
+                    if include_all==True:
+                        collected.append(child)
+                    child.leaves=None
+                    child.numChildren=0
+                    stack.append([child,0])
+
+            else: ## seen all children of node
                 if verbose==True:
-                    print('encountered leaf %s (%s or %s)'%(cur_node.index,cur_node.numName,cur_node.name))
-                cur_node.parent.numChildren+=1 ## parent has one more new child (congratulations!)
-                cur_node.parent.leaves.append(cur_node.numName) ## add the name of leaf to its parent's list of children names
-                cur_node.parent.leaves=sorted(cur_node.parent.leaves) ## sort parent's children list
-                seen.append(cur_node.index) ## leaf has now officially been seen
-                highestTip=float(height) ## set the height of the leaf as being potentially the highest tip
-                cur_node.height=height ## set leaf's height
+                    print('seen all children of node %s'%(cur_node.index))
+                stack.pop()
+                _count_tips(cur_node)
+                if cur_node==startNode and verbose==True:
+                    print('reached starting point %s'%(cur_node.index))
 
-                #if cur_node not in collected: ## if leaf hasn't been collected - add it for reporting later
-                collected.append(cur_node)
-                if maxHeight<=float(cur_node.height): ## is this the highest point we've seen in the tree so far?
-                    maxHeight=float(cur_node.height)
+        if startNode==self.root:
+            self.treeHeight=float(maxHeight) ## tree height of this tree is the height of the highest tip
+        return collected ## return a list of collected leaf objects
 
-                height-=float(cur_node.length) ## prepare for heading back
-                cur_node=cur_node.parent ## current node is now leaf's parent
-
-        self.treeHeight=float(maxHeight) ## tree height of this tree is the height of the highest tip
-        return unique(collected) ## return a list of collected leaf objects
+    def markDirty(self,k,subtree=False,sort=False):
+        """
+        Note that the length, parent or children of branch k have changed, or with subtree=True that everything below k is new to the tree.
+        Heights, tip counts, sort order and coordinates that depend on it are recomputed by update(), the next time branches of the tree are asked for.
+        With sort=True the tree is kept sorted from then on, as if sortBranches() was called after every change.
+        """
+        self.dirty[k]=self.dirty.get(k,False) or subtree
+        self.lca=None ## positions in the index may no longer match the tree
+        self.lookup=None
+        if sort==True and self.sorting!=True: ## not kept sorted in this order yet - sort and draw everything
+            self.sorting=True
+            self.dirty[self.root]=True
+
+    def update(self):
+        """
+        Recompute data derived from branches marked with markDirty(): heights, numbers of tips and lists of descendant tips, and,
+        if the tree is kept sorted, order of children and x and y coordinates. Only subtrees whose heights have changed
+        and nodes on the paths from changed branches to the root are visited, plus tips drawn before them if the vertical space
+        taken up by the changed subtrees is different. Called whenever Objects, nodes, leaves, treeHeight or ySpan are asked for.
+        """
+        if len(self.dirty)==0:
+            return
+        dirty=self.dirty
+        self.dirty={}
+        root=self.root
+        if self.sorting is not None and self.drawn==False: ## coordinates don't follow the order of the tree - draw everything
+            dirty[root]=True
+        if root.height is None:
+            root.height=0.0
+
+        region={root:None} ## changed branches still in the tree and nodes on their paths to the root
+        for k in dirty:
+            path=[]
+            while k is not root and k not in region:
+                if k.parent is None or k not in k.parent.children: ## no longer in the tree
+                    path=[]
+                    break
+                path.append(k)
+                k=k.parent
+            region.update(dict.fromkeys(path))
+
+        order=[] ## branches of the region in pre-order, except those in subtrees recomputed in full
+        full=[] ## subtrees recomputed in full, each in pre-order
+        stack=[root]
+        while len(stack)>0:
+            k=stack.pop()
+            height=k.height if k is root else k.parent.height+float(k.length)
+            if dirty.get(k)==True or height!=k.height:
+                k.height=height
+                full.append(_preorder(k))
+            else:
+                order.append(k)
+                if k.branchType=='node':
+                    stack+=[ch for ch in k.children[::-1] if ch in region]
+
+        for branches in full:
+            for k in branches[1:]:
+                k.height=k.parent.height+float(k.length)
+        nodes=[k for branches in full for k in reversed(branches) if k.branchType=='node'] ## children come before their parents
+        nodes+=[k for k in reversed(order) if k.branchType=='node']
+        for k in nodes:
+            k.leaves=None
+            _count_tips(k)
+        if self.sorting is not None:
+            for k in nodes:
+                if k is not root: ## root is not sorted by sortBranches either
+                    _sort_children(k,self.sorting)
+            self.drawn=True
+
+            span={} ## vertical space taken up by tips of subtrees in the region
+            ends={root:0} ## vertical space taken up by tips drawn after each subtree in the region
+            for branches in full:
+                for k in reversed(branches):
+                    span[k]=_skip(k) if k.branchType=='leaf' else sum([span[ch] for ch in k.children])
+            for k in reversed(order):
+                if k.branchType=='leaf':
+                    span[k]=_skip(k)
+                    continue
+                for ch in k.children:
+                    if ch not in region and ch not in span: ## subtree unchanged - can tell its span from where it has been drawn
+                        extent=_drawn_extent(ch)
+                        if extent is None: ## never drawn
+                            span[ch]=_draw_subtree(ch,0)
+                            ends[ch]=None
+                        else:
+                            span[ch],ends[ch]=extent
+                span[k]=sum([span[ch] for ch in k.children])
+            fullRoots=set([branches[0] for branches in full])
+            for k in order:
+                if k.branchType=='leaf':
+                    k.y=ends[k]+span[k]
+                    if isinstance(k,clade):
+                        k.y-=span[k]/2.0
+                    k.x=k.height
+                    continue
+                e=ends[k]
+                for ch in reversed(k.children):
+                    if ch in fullRoots:
+                        _draw_subtree(ch,e)
+                    elif ch in region:
+                        ends[ch]=e
+                    elif ends[ch] is None:
+                        _draw_subtree(ch,e)
+                    elif ends[ch]!=e: ## tips after this subtree take up a different amount of space now
+                        _shift_subtree(ch,e-ends[ch])
+                    e+=span[ch]
+            for k in reversed(order):
+                if k.branchType=='node' and k.parent is not None and len(k.children)>0:
+                    k.y=sum([ch.y for ch in k.children])/float(len(k.children))
+                    k.x=k.height
+            if root in fullRoots:
+                _draw_subtree(root,0)
+            self._ySpan=span[root]
+
+        self._leaves=None ## made again when asked for
+        self._nodes=None
+        self._treeHeight=float(max(0,root.childHeight))
+        self.lca=None
+        self.lookup=None
 
     def renameTips(self,d):
         """ Give each tip its correct label using a dictionary. """
@@ -326,103 +656,117 @@ class tree: ## tree class
             d=self.tipMap
         for k in self.leaves: ## iterate through leaf objects in tree
             k.name=d[k.numName] ## change its name
+        self.lookup=None ## both are keyed by tip name
+        self.lca=None
 
     def sortBranches(self,descending=True):
-        """ Sort descendants of each node. """
-        if descending==True:
-            modifier=-1 ## define the modifier for sorting function later
-        elif descending==False:
-            modifier=1
-
+        """ Sort descendants of each node. The tree is kept sorted this way after changes, see markDirty(). """
         for k in self.Objects: ## iterate over nodes
             if k.branchType=='node':
-                ## split node's offspring into nodes and leaves, sort each list individually
-                nodes=sorted([x for x in k.children if x.branchType=='node'],key=lambda q:(-len(q.leaves)*modifier,q.length*modifier))
-                leaves=sorted([x for x in k.children if x.branchType=='leaf'],key=lambda q:q.length*modifier)
-
-                if modifier==1: ## if sorting one way - nodes come first, leaves later
-                    k.children=nodes+leaves
-                elif modifier==-1: ## otherwise sort the other way
-                    k.children=leaves+nodes
+                _sort_children(k,descending)
         self.nodes=[k for k in self.Objects if k.branchType=='node']
+        self.sorting=descending
         self.drawTree() ## update x and y positions of each branch, since y positions will have changed because of sorting
 
     def drawTree(self,order=None):
-        """ Find x and y coordinates of each branch. """
+        """ Find x and y coordinates of each branch.
+        Tips are placed from running totals of the vertical space each tip takes up,
+        nodes are placed once all of their children have been, in a single pass. """
         if order==None:
             order=[x for x in self.traverse_tree() if x.branchType=='leaf'] ## order is a list of tips recovered from a tree traversal to make sure they're plotted in the correct order along the vertical tree dimension
+            self.drawn=True ## coordinates follow the order of the tree, so update() can keep them up to date
+        else:
+            self.drawn=False
 
-        name_order=[x.numName for x in order]
         skips=[1 if isinstance(x,leaf) else x.width+1 for x in order]
+        name_order={} ## position of each tip name in the order
+        for y_idx,x in enumerate(order):
+            name_order.setdefault(x.numName,y_idx)
+        remaining=[0]*(len(skips)+1) ## remaining[i] is the vertical space taken up by tips from position i onwards
+        for y_idx in range(len(skips)-1,-1,-1):
+            remaining[y_idx]=skips[y_idx]+remaining[y_idx+1]
 
         for k in self.Objects: ## reset coordinates for all objects
             k.x=None
             k.y=None
 
-        storePlotted=0
-        drawn=[] ## drawn keeps track of what's been drawn
-        while len(drawn)!=len(self.Objects): # keep drawing the tree until everything is drawn
-            for k in [x for x in self.Objects if x.index not in drawn]: ## iterate through objects that have not been drawn
-                if k.branchType=='leaf': ## if leaf - get position of leaf, draw branch connecting tip to parent node
-                    x=k.height ## x position is height
-                    y_idx=name_order.index(k.numName) ## y position of leaf is given by the order in which tips were visited during the traversal
-                    y=sum(skips[y_idx:]) ## sum across skips to find y position
-                    if isinstance(k,clade): ## if dealing with collapsed clade - adjust y position to be in the middle of the skip
-                        y-=skips[y_idx]/2.0
-                    k.x=x ## set x and y coordinates
-                    k.y=y
-                    drawn.append(k.index) ## remember that this objects has been drawn
-
-                if k.branchType=='node': ## if parent is non-root node and y positions of all its children are known
-                    if len([q.y for q in k.children if q.y!=None])==len(k.children):
-                        x=k.height ## x position is height
-                        children_y_coords=[q.y for q in k.children if q.y!=None] ## get all existing y coordinates of the node
-                        y=sum(children_y_coords)/float(len(children_y_coords)) ## internal branch is in the middle of the vertical bar
-                        k.x=x
-                        k.y=y
-                        drawn.append(k.index) ## remember that this objects has been drawn
-
-            assert len(drawn)>storePlotted,'Got stuck trying to find y positions of objects'
-            storePlotted=len(drawn)
-            self.ySpan=sum(skips)
+        waiting={} ## number of children of each node that have not been drawn yet
+        ready=[] ## nodes whose children have all been drawn
+        for k in self.Objects:
+            if k.branchType=='node':
+                waiting[k]=len([q for q in k.children if q.y==None])
+                if waiting[k]==0:
+                    ready.append(k)
+
+        drawn=0
+        for k in self.Objects:
+            if k.branchType=='leaf': ## if leaf - get position of leaf
+                y_idx=name_order[k.numName] ## y position of leaf is given by the order in which tips were visited during the traversal
+                y=remaining[y_idx] ## vertical space taken up by this tip and all the ones after it
+                if isinstance(k,clade): ## if dealing with collapsed clade - adjust y position to be in the middle of the skip
+                    y-=skips[y_idx]/2.0
+                k.x=k.height ## x position is height
+                k.y=y
+                drawn+=1
+                if k.parent in waiting: ## one more child of the parent drawn
+                    waiting[k.parent]-=1
+                    if waiting[k.parent]==0:
+                        ready.append(k.parent)
+
+        while len(ready)>0: ## draw nodes from the tips towards the root
+            k=ready.pop()
+            children_y_coords=[q.y for q in k.children] ## get all existing y coordinates of the node
+            k.x=k.height ## x position is height
+            k.y=sum(children_y_coords)/float(len(children_y_coords)) ## internal branch is in the middle of the vertical bar
+            drawn+=1
+            if k.parent in waiting:
+                waiting[k.parent]-=1
+                if waiting[k.parent]==0:
+                    ready.append(k.parent)
+
+        assert drawn==len(self.Objects),'Got stuck trying to find y positions of objects'
+        self.ySpan=sum(skips)
 
     def drawUnrooted(self,n=None,total=None):
         """
         Calculate x and y coordinates in an unrooted arrangement.
         Code translated from https://github.com/nextstrain/auspice/commit/fc50bbf5e1d09908be2209450c6c3264f298e98c,
         written by Richard Neher.
+        Branches are visited in pre-order from the tree's lcaIndex, so there is no recursion and no depth limit.
+        Each branch gets a wedge of angles proportional to its number of tips; only x and y are written.
         """
-        if n==None:
+        if total==None:
             total=sum([1 if isinstance(x,leaf) else x.width+1 for x in [w for w in self.Objects if w.branchType=='leaf']])
+        if n==None:
             n=self.root.children[0]
+            self.drawn=False
             for k in self.Objects:
-                k.traits['tau']=0.0
                 k.x=0.0
                 k.y=0.0
 
-        if n.branchType=='leaf':
-            w=2*math.pi*1.0/float(total)
-        else:
-            w=2*math.pi*len(n.leaves)/float(total)
-
         if n.parent.x==None:
             n.parent.x=0.0
             n.parent.y=0.0
 
-        n.x = n.parent.x + n.length * math.cos(n.traits['tau'] + w*0.5)
-        n.y = n.parent.y + n.length * math.sin(n.traits['tau'] + w*0.5)
-        eta=n.traits['tau']
+        index=self.getLCAIndex()
+        start=index.position[n]
+        stop=int(index.end[start])
+        unit=2*math.pi/float(total)
+        numTips=(index.tipEnd[start:stop]-index.tipStart[start:stop]).tolist()
+        tau=[0.0]*(stop-start) ## angle at which each branch's wedge starts, by pre-order position from n
 
-        if n.branchType=='node':
-            for ch in n.children:
-                if ch.branchType=='leaf':
-                    w=2*math.pi*1.0/float(total)
-                else:
-                    w=2*math.pi*len(ch.leaves)/float(total)
-                ch.traits['tau'] = eta
-                eta += w
-                self.drawUnrooted(ch,total)
+        for i in range(stop-start):
+            k=index.order[start+i]
+            w=unit*numTips[i]
+            k.x = k.parent.x + k.length * math.cos(tau[i] + w*0.5)
+            k.y = k.parent.y + k.length * math.sin(tau[i] + w*0.5)
 
+            if k.branchType=='node':
+                eta=tau[i]
+                for ch in k.children:
+                    c=index.position[ch]-start
+                    tau[c]=eta
+                    eta+=unit*numTips[c]
 
     def traverseWithinTrait(self,startNode,traitName,converterDict=None):
         """ Traverse the tree staying within the trait value of the node provided.
@@ -499,78 +843,179 @@ class tree: ## tree class
                     collected.append(cur_node)
                 cur_node=cur_node.parent
 
+    def getLCAIndex(self):
+        """
+        Returns the most recent common ancestor index (lcaIndex) of the tree, building it if needed.
+        The index is dropped whenever the tree is traversed or a branch is marked with markDirty(), which every method
+        changing the topology does. Code that moves branches by editing parent and children itself has to do the same.
+        """
+        if len(self.dirty)>0:
+            self.update()
+        if self.lca is None:
+            self.lca=lcaIndex(self.root)
+        return self.lca
+
+    def getLookup(self):
+        """
+        Returns dictionaries from tip name ('name'), tip numName ('numName') and branch index ('index') to objects in the tree, building them if needed.
+        Collapsed clades count as tips. The dictionaries are dropped whenever the tree is traversed, a branch is marked with markDirty()
+        or tips are renamed with renameTips(). Tips renamed by assigning k.name directly are only found once tree.lookup is set to None.
+        """
+        if len(self.dirty)>0:
+            self.update() ## drops the lookup, so bring the tree up to date before building it
+        if self.lookup is None:
+            lookup={'name':{},'numName':{},'index':{self.root.index:self.root}}
+            for k in self.Objects:
+                lookup['index'][k.index]=k
+                if k.branchType=='leaf':
+                    lookup['name'][k.name]=k
+                    lookup['numName'][k.numName]=k
+            self.lookup=lookup
+        return self.lookup
+
+    def leaf_by_name(self,name,numName=False):
+        """
+        Returns the leaf (or collapsed clade) with the given name (or numName if numName=True), or None if there is none.
+        Rename tips with renameTips(), see getLookup().
+        """
+        key='numName' if numName==True else 'name'
+        k=self.getLookup()[key].get(name)
+        if k is not None and getattr(k,key)!=name: ## leaf was renamed directly rather than with renameTips
+            self.lookup=None
+            k=self.getLookup()[key].get(name)
+        return k
+
+    def branch_by_index(self,index):
+        """ Returns the branch with the given index, or None if there is none. """
+        k=self.getLookup()['index'].get(index)
+        if k is not None and k.index!=index:
+            self.lookup=None
+            k=self.getLookup()['index'].get(index)
+        return k
+
+    def tipsOf(self,k):
+        """ Tips (and collapsed clades) descended from branch k in pre-order, read off the tree's lcaIndex without traversing the subtree. """
+        return self.getLCAIndex().tipsOf(k)
+
+    def isDescendant(self,k,ancestor):
+        """ Whether branch k descends from (or is) branch ancestor, in constant time using the tree's lcaIndex. """
+        return self.getLCAIndex().isDescendant(k,ancestor)
+
     def commonAncestor(self,descendants,numName=False):
+        """
+        Find the most recent node ancestral to all given tips, identified by name (or numName if numName=True).
+        Uses the tree's lcaIndex, so each query takes time proportional to the number of tips given.
+        """
         types=[desc.__class__ for desc in descendants]
         assert len(set(types))==1,'More than one type of data detected in descendants list'
-        if numName==False:
-            assert sum([1 if k in [w.name for w in self.Objects if w.branchType=='leaf'] else 0 for k in descendants])==len(descendants),'Not all specified descendants are in tree: %s'%(descendants)
-        else:
-            assert sum([1 if k in [w.numName for w in self.Objects if w.branchType=='leaf'] else 0 for k in descendants])==len(descendants),'Not all specified descendants are in tree: %s'%(descendants)
-        dtype=list(set(types))[0]
-        allAncestors=sorted([k for k in self.Objects if k.branchType=='node' and len(k.leaves)>=len(descendants)],key=lambda x:x.height)
-        if numName==False:
-            ancestor=[k for k in allAncestors if sum([[self.tipMap[w] for w in k.leaves].count(l) for l in descendants])==len(descendants)][-1]
-        else:
-            ancestor=[k for k in allAncestors if sum([[w for w in k.leaves].count(l) for l in descendants])==len(descendants)][-1]
+        index=self.getLCAIndex()
+        lookup=index.numName if numName==True else index.name
+        assert all([k in lookup for k in descendants]),'Not all specified descendants are in tree: %s'%(descendants)
+        ancestor=index.mrcaOf([lookup[k] for k in descendants])
+        if ancestor.branchType=='leaf': ## a single tip - its ancestor is the node it descends from
+            ancestor=ancestor.parent
         return ancestor
 
     def collapseSubtree(self,cl,givenName,verbose=False,widthFunction=lambda x:x):
         """ Collapse an entire subtree into a clade object. """
-        assert cl.branchType=='node','Cannot collapse non-node class'
-        collapsedClade=clade(givenName)
-        collapsedClade.index=cl.index
-        collapsedClade.length=cl.length
-        collapsedClade.height=cl.height
-        collapsedClade.parent=cl.parent
-        collapsedClade.absoluteTime=cl.absoluteTime
-        collapsedClade.traits=cl.traits
-        collapsedClade.width=widthFunction(len(cl.leaves))
+        self.collapse_many([cl],[givenName],verbose=verbose,widthFunction=widthFunction)
 
-        if verbose==True:
-            print('Replacing node %s (parent %s) with a clade class'%(cl.index,cl.parent.index))
-        parent=cl.parent
-        #collapsedClade.subtree=cl
-
-        remove_from_tree=self.traverse_tree(cl,include_all=True)
-        collapsedClade.subtree=remove_from_tree
-        assert len(remove_from_tree)<len(self.Objects),'Attempted collapse of entire tree'
-        collapsedClade.lastHeight=max([x.height for x in remove_from_tree])
-        collapsedClade.lastAbsoluteTime=max([x.absoluteTime for x in remove_from_tree])
-
-        for k in remove_from_tree:
-            self.Objects.remove(k)
-
-        parent.children.remove(cl)
-        parent.children.append(collapsedClade)
-        self.Objects.append(collapsedClade)
-        collapsedClade.parent=parent
-        if self.tipMap!=None:
-            self.tipMap[givenName]=givenName
+    def collapse_many(self,clades,names,verbose=False,widthFunction=lambda x:x):
+        """
+        Collapse each of the subtrees starting at nodes in clades into a clade object, named after the matching entry of names.
+        Only the paths from the new clades to the root are recomputed, once, when the tree is next looked at (see update). Subtrees cannot overlap.
+        """
+        assert len(clades)==len(names),'Need one name per clade'
+        self.update() ## subtrees are collapsed as they are currently sorted
+        removed=set() ## branches that disappear into collapsed clades
+        collapsed=[]
+        for cl,givenName in zip(clades,names):
+            assert cl.branchType=='node','Cannot collapse non-node class'
+            assert cl not in removed,'Clade %s is inside another collapsed clade'%(givenName)
+            collapsedClade=clade(givenName)
+            collapsedClade.index=cl.index
+            collapsedClade.length=cl.length
+            collapsedClade.height=cl.height
+            collapsedClade.parent=cl.parent
+            collapsedClade.absoluteTime=cl.absoluteTime
+            collapsedClade.traits=cl.traits
+            collapsedClade.width=widthFunction(cl.numChildren)
 
-        self.traverse_tree()
-        self.sortBranches()
+            if verbose==True:
+                print('Replacing node %s (parent %s) with a clade class'%(cl.index,cl.parent.index))
+            parent=cl.parent
+
+            remove_from_tree=[] ## branches of the subtree in pre-order
+            stack=[cl]
+            while len(stack)>0:
+                k=stack.pop()
+                remove_from_tree.append(k)
+                if k.branchType=='node':
+                    stack+=k.children[::-1]
+            collapsedClade.subtree=remove_from_tree
+            assert len(remove_from_tree)<len(self.Objects)-len(removed),'Attempted collapse of entire tree'
+            collapsedClade.lastHeight=max([x.height for x in remove_from_tree])
+            collapsedClade.lastAbsoluteTime=max([x.absoluteTime for x in remove_from_tree])
+            removed.update(remove_from_tree)
+
+            parent.children.remove(cl)
+            parent.children.append(collapsedClade)
+            self.Objects.append(collapsedClade)
+            collapsedClade.parent=parent
+            if self.tipMap!=None:
+                self.tipMap[givenName]=givenName
+            collapsed.append(collapsedClade)
+
+        self.Objects=[k for k in self.Objects if k not in removed]
+        for k in collapsed: ## only the paths from collapsed clades to the root are recomputed
+            self.markDirty(k,sort=True)
 
     def uncollapseSubtree(self):
-        """ Uncollapse all collapsed subtrees. """
-        while len([k for k in self.Objects if isinstance(k,clade)])>0:
-            clades=[k for k in self.Objects if isinstance(k,clade)]
+        """
+        Uncollapse all collapsed subtrees. Subtrees come back as the last child of their parents and, as after traverse_tree(),
+        the tree is no longer kept sorted and coordinates are left as they were; call sortBranches() to sort and draw it again.
+        """
+        self.update() ## earlier changes are sorted and drawn as they would have been
+        self.sorting=None
+        clades=[k for k in self.Objects if isinstance(k,clade)]
+        removed=set()
+        uncollapsed=[]
+        while len(clades)>0:
+            restored=[] ## clades collapsed inside other clades come back with their subtrees
             for cl in clades:
                 parent=cl.parent
                 subtree=cl.subtree
                 parent.children.remove(cl)
                 parent.children.append(subtree[0])
+                subtree[0].parent=parent ## clade may have been moved since it was collapsed
+                subtree[0].length=cl.length
                 self.Objects+=subtree
-                self.Objects.remove(cl)
+                removed.add(cl)
+                restored+=[k for k in subtree if isinstance(k,clade)]
                 if self.tipMap!=None:
                     self.tipMap.pop(cl.name,None)
-        self.traverse_tree()
+                uncollapsed.append(subtree[0])
+            clades=restored
+        self.Objects=[k for k in self.Objects if k not in removed]
+        for k in uncollapsed:
+            self.markDirty(k,subtree=True)
 
-    def collapseBranches(self,trait='posterior',f=lambda x:x<=0.5,designated_nodes=[],verbose=False):
+    def collapseBranches(self,trait='posterior',f=lambda x:x<=0.5,designated_nodes=[],vectorized=False,verbose=False):
         """ Collapse all branches according to whether an attribute or trait value (default is "posterior" trait) satisfies an anonymous function f (default is return true if value is <=0.5).
+            With vectorized=True f is called once, with a numpy array of the values of every node that has the trait, and should return an array of booleans.
             Alternatively, a list of nodes can be supplied to the script.
-            Returns a deep copied version of the tree.
+            Returns a copied version of the tree.
+            Children of collapsed nodes are appended to the children of the node they end up attached to and the tree is then sorted,
+            so siblings that tie in sortBranches() follow the order in which nodes were collapsed.
         """
-        newTree=copy.deepcopy(self) ## work on a copy of the tree
+        copies=self.copyBranches([self.root]+self.Objects) ## work on a copy of the tree
+        newTree=tree()
+        newTree.root=copies[self.root]
+        newTree.Objects=[copies[k] for k in self.Objects]
+        newTree.nodes=[copies[k] for k in self.nodes if k in copies]
+        newTree.leaves=[copies[k] for k in self.leaves if k in copies]
+        newTree.tipMap=None if self.tipMap is None else dict(self.tipMap)
+        newTree.treeHeight=self.treeHeight
         if len(designated_nodes)==0: ## no nodes were designated for deletion - relying on anonymous function to collapse nodes
             if sum([1 if hasattr(q,trait) else 0 for q in newTree.nodes])==len(newTree.nodes): ## every node has attribute
                 def get_value(ob,tr):
@@ -582,213 +1027,1117 @@ class tree: ## tree class
                     return ob.traits[tr]
                 if verbose==True:
                     print('Collapsing based on trait')
-            nodes_to_delete=[n for n in newTree.nodes if trait in n.traits and f(get_value(n,trait))==True] ## fetch a list of all nodes who are not the root and who satisfy the condition
+            candidates=[n for n in newTree.nodes if trait in n.traits]
+            if vectorized==True: ## one call over the whole column of values
+                mask=np.asarray(f(np.array([get_value(n,trait) for n in candidates])),dtype=bool).tolist()
+                nodes_to_delete=[n for n,m in zip(candidates,mask) if m==True]
+            else:
+                nodes_to_delete=[n for n in candidates if f(get_value(n,trait))==True] ## fetch a list of all nodes who are not the root and who satisfy the condition
         else:
             assert [w.branchType for w in designated_nodes].count('node')==len(designated_nodes),'Non-node class detected in list of nodes designated for deletion'
             assert len([w for w in designated_nodes if w.parent.index=='Root'])==0,'Root node was designated for deletion'
-            nodes_to_delete=[w for w in newTree.Objects if w.index in [q.index for q in designated_nodes]] ## need to look up nodes designated for deletion by their indices, since the tree has been copied and nodes will have new memory addresses
+            designated=set([q.index for q in designated_nodes])
+            nodes_to_delete=[w for w in newTree.Objects if w.index in designated] ## need to look up nodes designated for deletion by their indices, since the tree has been copied and nodes will have new memory addresses
         if verbose==True:
             print('%s nodes set for collapsing: %s'%(len(nodes_to_delete),[w.index for w in nodes_to_delete]))
         assert len(nodes_to_delete)<len(newTree.nodes)-1,'Chosen cutoff would remove all branches'
-        while len(nodes_to_delete)>0: ## as long as there are branches to be collapsed - keep reducing the tree
+
+        deleted=set(nodes_to_delete)
+        children={} ## children of nodes that gain or lose children, as dictionaries so that they can be removed and appended cheaply in order
+        for k in sorted(nodes_to_delete,key=lambda x:-x.height): ## start with branches near the tips, nodes at the same height in the order of Objects
+            new_parent=k.parent ## once node is deleted, the parent to all their children will be the parent of the deleted node
+            if new_parent not in children:
+                children[new_parent]=dict.fromkeys(new_parent.children)
+            zero_node=children.pop(k) if k in children else dict.fromkeys(k.children) ## fetch the node's children
             if verbose==True:
-                print('Continuing collapse cycle, %s nodes left'%(len(nodes_to_delete)))
-            for k in sorted(nodes_to_delete,key=lambda x:-x.height): ## start with branches near the tips
-                zero_node=k.children ## fetch the node's children
-                k.parent.children+=zero_node ## add them to the zero node's parent
-                old_parent=k ## node to be deleted is the old parent
-                new_parent=k.parent ## once node is deleted, the parent to all their children will be the parent of the deleted node
-                if verbose==True:
-                    print('Removing node %s, attaching children %s to node %s'%(old_parent.index,[w.index for w in k.children],new_parent.index))
-                for w in newTree.Objects: ## assign the parent of deleted node as the parent to any children of deleted node
-                    if w.parent==old_parent:
-                        w.parent=new_parent
-                        w.length+=old_parent.length
-                        if verbose==True:
-                            print('Fixing branch length for node %s'%(w.index))
-                k.parent.children.remove(k) ## remove traces of deleted node - it doesn't exist as a child, doesn't exist in the tree and doesn't exist in the nodes list
-                newTree.Objects.remove(k)
-                newTree.nodes.remove(k)
-                nodes_to_delete.remove(k) ## in fact, the node never existed
-                if verbose==True:
-                    print('Removing references to node %s'%(k.index))
-        newTree.sortBranches() ## sort the tree to traverse, draw and sort tree to adjust y coordinates
+                print('Removing node %s, attaching children %s to node %s'%(k.index,[w.index for w in zero_node],new_parent.index))
+            for w in zero_node: ## assign the parent of deleted node as the parent to any children of deleted node
+                w.parent=new_parent
+                w.length+=k.length
+                children[new_parent][w]=None ## add them to the zero node's parent
+            del children[new_parent][k] ## remove traces of deleted node - it doesn't exist as a child
+        for k,ch in children.items():
+            k.children=list(ch)
+        newTree.Objects=[w for w in newTree.Objects if w not in deleted] ## doesn't exist in the tree and doesn't exist in the nodes list
+        newTree.nodes=[w for w in newTree.nodes if w not in deleted]
+        newTree.markDirty(newTree.root,subtree=True,sort=True) ## sort the tree to traverse, draw and sort tree to adjust y coordinates, once it's looked at
         return newTree ## return collapsed tree
 
-    def toString(self,traits=[],numName=False,verbose=False,nexus=False):
-        """ Output the topology of the tree with branch lengths to string """
-        cur_node=self.root
-        seen=[]
-        tree_string=[]
-        root=False
-
-        while root==False:
-            if cur_node.branchType=='node':
+    def newickPieces(self,traits=[],numName=False,verbose=False,tipLabels=None):
+        """
+        Generator of consecutive pieces of the tree's newick string (without the final semicolon), in a single pass without recursion.
+        Traits listed in traits are written as comments (strings, floats and lists of those).
+        Tips are labelled with their names, numNames if numName=True, or with tipLabels (dictionary from leaf object to label) if given.
+        """
+        formats=[(tr,tr+'="',tr+'=',tr+'={') for tr in traits] ## prefixes are made once per trait, not once per branch
+        def annotate(k):
+            comment=[]
+            for tr,string,number,vector in formats:
+                if tr in k.traits:
+                    value=k.traits[tr]
+                    if isinstance(value,str):
+                        comment.append(string+value+'"')
+                    elif isinstance(value,float):
+                        comment.append(number+'%s'%(value))
+                    elif isinstance(value,list):
+                        comment.append(vector+','.join(['"%s"'%(val) if isinstance(val,str) else '%s'%(val) for val in value if isinstance(val,(str,float))])+'}')
+            if len(comment)>0:
+                return '[&'+','.join(comment)+']'
+            return ''
+
+        if len(self.root.children)==0:
+            return
+        stack=[self.root.children[0]] ## branches still to write, interleaved with commas and closing brackets
+        while len(stack)>0:
+            k=stack.pop()
+            if isinstance(k,str):
+                yield k
+            elif isinstance(k,tuple): ## all children written - close the node
+                k=k[0]
+                yield ')%s:%8f'%(annotate(k),k.length) ## end of node, add branch length with annotations
+            elif k.branchType=='leaf':
                 if verbose==True:
-                    print('Encountered node %s'%(cur_node.index))
-                ## if all children have been seen and not at root
-                while sum([1 if x.index in seen else 0 for x in cur_node.children])==len(cur_node.children) and cur_node.index!='Root':
-                    if cur_node.parent.index=='Root':
-                        root=True
-                        break
-                    else:
-                        comment=[]
-                        if len(traits)>0:
-                            for tr in traits:
-                                if tr in cur_node.traits:
-                                    if isinstance(cur_node.traits[tr],str):
-                                        comment.append('%s="%s"'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],float):
-                                        comment.append('%s=%s'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],list):
-                                        rangeComment=[]
-                                        for val in cur_node.traits[tr]:
-                                            if isinstance(val,str):
-                                                rangeComment.append('"%s"'%(val))
-                                            elif isinstance(val,float):
-                                                rangeComment.append('%s'%(val))
-                                        comment.append('%s={%s}'%(tr,','.join(rangeComment)))
-                        if len(comment)>0:
-                            comment=','.join(comment)
-                            comment='[&'+comment+']'
-                            tree_string.append(')%s:%8f'%(comment,cur_node.length)) ## end of node, add branch length with annotations
-                        else:
-                            tree_string.append('):%8f'%(cur_node.length)) ## end of node, add branch length
-                        cur_node=cur_node.parent ## go back
-
-                seen.append(cur_node.index)
-                last_seen=[1 if x.index in seen else 0 for x in cur_node.children]
-
-                if 0 in last_seen: ## there's unvisited children
-                    idx_to_visit=last_seen.index(0)
-                    if idx_to_visit>0: ## first child definitely seen, so visiting the second child at the very least
-                        tree_string.append(',') ## add comma to indicate bifurcation
-                    cur_node=cur_node.children[idx_to_visit]
-
-                    if cur_node.branchType=='node':
-                        tree_string.append('(') ## dealing with new node, add (
-                    else:
-                        comment=[]
-                        if len(traits)>0: ## if a designated trait list exists
-                            for tr in traits: ## iterate over traits
-                                if tr in cur_node.traits:
-                                    if isinstance(cur_node.traits[tr],str):
-                                        comment.append('%s="%s"'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],float):
-                                        comment.append('%s=%s'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],list):
-                                        rangeComment=[]
-                                        for val in cur_node.traits[tr]:
-                                            if isinstance(val,str):
-                                                rangeComment.append('"%s"'%(val))
-                                            elif isinstance(val,float):
-                                                rangeComment.append('%s'%(val))
-                                        comment.append('%s={%s}'%(tr,','.join(rangeComment)))
-
-                        if numName==False: ## if real names wanted
-                            assert cur_node.name!=None,'Tip does not have converted names' ## assert they have been converted
-                            treeName=cur_node.name ## designate real name
-                        elif numName==True: ## if number names wanted
-                            treeName=cur_node.numName ## designated numName
-
-                        if len(comment)>0:
-                            comment=','.join(comment) ## join up traits with commas
-                            comment='[&'+comment+']' ## add starting and end bracket
-                            tree_string.append('\'%s\'%s:%8f'%(treeName,comment,cur_node.length)) ## dealing with tip, write out name, add branch length with annotation
-                        else:
-                            tree_string.append('\'%s\':%8f'%(treeName,cur_node.length)) ## dealing with tip, write out name, add branch length
-
-                else: ## all children seen, clade's end
-                    comment=[]
-                    if len(traits)>0:
-                        for tr in traits:
-                            if tr in cur_node.traits:
-                                    if isinstance(cur_node.traits[tr],str):
-                                        comment.append('%s="%s"'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],float):
-                                        comment.append('%s=%s'%(tr,cur_node.traits[tr]))
-                                    elif isinstance(cur_node.traits[tr],list):
-                                        rangeComment=[]
-                                        for val in cur_node.traits[tr]:
-                                            if isinstance(val,str):
-                                                rangeComment.append('"%s"'%(val))
-                                            elif isinstance(val,float):
-                                                rangeComment.append('%s'%(val))
-                                        comment.append('%s={%s}'%(tr,','.join(rangeComment)))
-                    if len(comment)>0:
-                        comment=','.join(comment)
-                        comment='[&'+comment+']'
-                        tree_string.append(')%s:%8f'%(comment,cur_node.length))
-                    else:
-                        tree_string.append('):%8f'%(cur_node.length))
-                    cur_node=cur_node.parent
-
-            elif cur_node.branchType=='leaf':
+                    print('Encountered leaf %s'%(k.index))
+                if tipLabels is not None:
+                    treeName=tipLabels[k]
+                elif numName==False: ## if real names wanted
+                    assert k.name!=None,'Tip does not have converted names' ## assert they have been converted
+                    treeName=k.name
+                else:
+                    treeName=k.numName
+                yield '\'%s\'%s:%8f'%(treeName,annotate(k),k.length) ## write out name, add branch length with annotations
+            else:
                 if verbose==True:
-                    print('Encountered leaf %s'%(cur_node.index))
-                seen.append(cur_node.index)
-                if cur_node.parent.index=='Root':
-                    root=True
-                    break
+                    print('Encountered node %s'%(k.index))
+                yield '('
+                stack.append((k,))
+                for c in range(len(k.children)-1,-1,-1):
+                    stack.append(k.children[c])
+                    if c>0:
+                        stack.append(',')
+
+    def toFile(self,handle,traits=[],numName=False,verbose=False,nexus=False,translate=False,chunkSize=65536):
+        """
+        Write the tree to a file handle (or path) as newick, or as NEXUS if nexus=True, about chunkSize characters at a time.
+        With translate=True tips are written as numbers and listed in a translate block, which implies nexus=True.
+        traits and numName are as in newickPieces.
+        """
+        if isinstance(handle,str):
+            with open(handle,'w') as f:
+                self.toFile(f,traits=traits,numName=numName,verbose=verbose,nexus=nexus,translate=translate,chunkSize=chunkSize)
+            return
+
+        tipLabels=None
+        header=[]
+        if translate==True:
+            nexus=True
+            tips=[]
+            stack=self.root.children[:1]
+            while len(stack)>0: ## tips in the order they are written
+                k=stack.pop()
+                if k.branchType=='leaf':
+                    tips.append(k)
                 else:
-                    cur_node=cur_node.parent
-
-        if nexus==True:
-            return '#NEXUS\nBegin trees;\ntree TREE1 = [&R] %s;\nEnd;'%(''.join(tree_string))
-        else:
-            return ''.join(tree_string)+';' ## the coup de grace
+                    stack+=k.children[::-1]
+            tipLabels={k:i+1 for i,k in enumerate(tips)}
+            header.append('#NEXUS\nBegin trees;\n\tTranslate\n')
+            header.append(',\n'.join(["\t\t%d '%s'"%(tipLabels[k],k.numName if numName==True else k.name) for k in tips]))
+            header.append('\n;\ntree TREE1 = [&R] ')
+        elif nexus==True:
+            header.append('#NEXUS\nBegin trees;\ntree TREE1 = [&R] ')
+
+        pieces=[]
+        size=0
+        for piece in itertools.chain(header,self.newickPieces(traits=traits,numName=numName,verbose=verbose,tipLabels=tipLabels),[';\nEnd;' if nexus==True else ';']):
+            pieces.append(piece)
+            size+=len(piece)
+            if size>=chunkSize:
+                handle.write(''.join(pieces))
+                pieces=[]
+                size=0
+        handle.write(''.join(pieces))
+
+    def toString(self,traits=[],numName=False,verbose=False,nexus=False,translate=False):
+        """ Output the topology of the tree with branch lengths to string, see toFile. """
+        handle=io.StringIO()
+        self.toFile(handle,traits=traits,numName=numName,verbose=verbose,nexus=nexus,translate=translate,chunkSize=len(self.Objects)*16+1024)
+        return handle.getvalue()
 
     def allTMRCAs(self):
-        tip_names=[k.numName for k in self.Objects if isinstance(k,leaf)]
-        tmrcaMatrix={x:{y:None for y in tip_names} for x in tip_names} ## pairwise matrix of tips
-
-        for k in self.Objects:
-            if isinstance(k,node):
-                all_children=k.leaves ## fetch all descendant tips of node
-                #print all_children
-                for x in range(0,len(all_children)-1): ## for all pairwise comparisons of tips
-                    for y in range(x+1,len(all_children)):
-                        tipA=all_children[x]
-                        tipB=all_children[y]
-                        if tmrcaMatrix[tipA][tipB]==None or tmrcaMatrix[tipA][tipB]<=k.absoluteTime: ## if node's time is more recent than previous entry - set new TMRCA value for pair of tips
-                            tmrcaMatrix[tipA][tipB]=k.absoluteTime
-                            tmrcaMatrix[tipB][tipA]=k.absoluteTime
+        """ Dictionary of dictionaries with the absolute time of the common ancestor of every pair of tips, keyed by numName. """
+        tips=[k for k in self.Objects if isinstance(k,leaf)]
+        matrix=self.tmrcaMatrix(tips).tolist()
+        tmrcaMatrix={x.numName:{y.numName:None for y in tips} for x in tips} ## pairwise matrix of tips
+        for i,x in enumerate(tips):
+            for j,y in enumerate(tips):
+                if i!=j:
+                    tmrcaMatrix[x.numName][y.numName]=matrix[i][j]
         return tmrcaMatrix
 
-    def reduceTree(self,keep):
+    def patristicMatrix(self,tips=None,numName=False,dtype=np.float64,memmap=None,chunkSize=1024):
+        """
+        Matrix of pairwise patristic (tip to common ancestor to tip) distances, as a numpy array.
+        tips are leaf objects, names (or numNames if numName=True), in the order of rows and columns; all tips in self.leaves by default.
+        If memmap is a path the matrix is written there chunkSize rows at a time as a .npy memory map, for matrices too big to hold in memory.
+        Distances are calculated from branch heights, so the tree needs to be traversed.
+        """
+        return _tip_matrix(self,tips,numName,'height',True,dtype,memmap,chunkSize)
+
+    def tmrcaMatrix(self,tips=None,numName=False,absoluteTime=True,dtype=np.float64,memmap=None,chunkSize=1024):
+        """
+        Matrix of the time of the most recent common ancestor of every pair of tips, as a numpy array.
+        Uses absolute times (see setAbsoluteTime) or heights if absoluteTime=False. The diagonal holds each tip's own time.
+        tips, memmap and chunkSize are as in patristicMatrix.
+        """
+        return _tip_matrix(self,tips,numName,'absoluteTime' if absoluteTime==True else 'height',False,dtype,memmap,chunkSize)
+
+    def tipNames(self,numName=False):
+        """
+        Names of the tree's tips in pre-order, or numNames if numName=True.
+        Falls back to numNames when no tip has a name, as in trees straight from make_tree that were never renamed.
+        """
+        tips=self.getLCAIndex().tips
+        key='numName' if numName==True or all([k.name is None for k in tips]) else 'name'
+        names=[getattr(k,key) for k in tips]
+        assert all([name is not None for name in names]),'Some tips have no %s, name them (e.g. with renameTips) or use numName=True'%(key)
+        return names
+
+    def bipartitions(self,tipOrder=None,numName=False,trivial=False):
+        """
+        Splits of the tips made by the tree's branches, as a dictionary from each split, a Python int bitset, to its branch length.
+        Bit i stands for tip tipOrder[i], tips being identified as in tipNames(numName); sorted tip names by default.
+        A split is written as its side without tipOrder[0], so it has the same bitset in every tree over these tips.
+        The root is ignored: the branches either side of it make one split, with their lengths summed.
+        Splits off a single tip are left out unless trivial=True.
+        """
+        index=self.getLCAIndex()
+        names=self.tipNames(numName)
+        if tipOrder is None:
+            tipOrder=sorted(names)
+        bit={name:i for i,name in enumerate(tipOrder)}
+        assert len(bit)==len(names) and all([name in bit for name in names]),'Tips of the tree do not match tipOrder'
+        everything=(1<<len(bit))-1
+
+        bits=[0]*len(index.order)
+        for i in range(len(index.order)-1,0,-1): ## children are folded into parents before parents are read
+            k=index.order[i]
+            if k.branchType=='leaf':
+                bits[i]=1<<bit[names[index.tipStart[i]]]
+            bits[index.position[k.parent]]|=bits[i]
+
+        splits={}
+        for i in range(1,len(index.order)):
+            b=bits[i]^everything if bits[i]&1 else bits[i]
+            size=bin(b).count('1')
+            if size==0 or (trivial==False and (size==1 or size==len(bit)-1)): ## no split, or a single tip on one side
+                continue
+            splits[b]=splits.get(b,0.0)+(index.order[i].length or 0.0)
+        return splits
+
+    def copyBranches(self,branches,view=False):
+        """
+        Copy the given branches of this tree into new node, leaf and clade objects, returned as a dictionary from each branch to its copy.
+        Parents and children are pointed at the copies, children that were not copied are left out and parents that were not copied become None.
+        Traits (and subtrees of collapsed clades) are copied too, unless view=True, in which case they are shared with this tree.
+        """
+        copies={}
+        for k in branches:
+            new=k.__class__.__new__(k.__class__)
+            for attr in k.__class__.__slots__:
+                setattr(new,attr,getattr(k,attr))
+            copies[k]=new
+        memo={id(k):new for k,new in copies.items()} ## deep copies of collapsed subtrees attach to the copies
+        for k,new in copies.items():
+            new.parent=copies.get(k.parent)
+            if view==False:
+                if all([isinstance(v,(str,float,int)) for v in k.traits.values()]):
+                    new.traits=dict(k.traits)
+                else:
+                    new.traits=copy.deepcopy(k.traits)
+            if isinstance(k,node):
+                new.children=[copies[ch] for ch in k.children if ch in copies]
+                new.leaves=None
+            elif isinstance(k,clade):
+                new.leaves=list(k.leaves)
+                if view==False:
+                    new.subtree=copy.deepcopy(k.subtree,memo)
+        return copies
+
+    def reduceTree(self,keep,view=False):
         """
         Reduce the tree to just those tracking a small number of tips.
-        Returns a new baltic tree object.
+        Returns a new baltic tree object, made of copies of just the branches that are kept (see copyBranches for view).
         """
         assert len(keep)>0,"No tips given to reduce the tree to."
+        self.update()
         assert len([k for k in keep if k.branchType!='leaf'])==0, "Embedding contains %d non-leaf branches."%(len([k for k in keep if k.branchType!='leaf']))
-        embedding=[]
-        reduced_tree=copy.deepcopy(self) ## new tree object
-        for k in reduced_tree.Objects: ## deep copy branches from current tree
-            if k.index in [q.index for q in keep]: ## if branch is designated as one to keep
+        embedding={} ## branches on the paths from kept tips to the root, in the order they were found
+        for q in keep:
+            for k in [q,self.branch_by_index(q.index)]: ## tips can also come from a copy of this tree, then they are matched by index
+                if k is None:
+                    continue
+                path=[]
                 cur_b=k
-                while cur_b: ## descend to root
-                    embedding.append(cur_b) ## keep track of the path to root
+                while cur_b is not None and cur_b not in embedding: ## descend to root, or to a path seen already
+                    path.append(cur_b)
                     cur_b=cur_b.parent
-                embedding=list(set(embedding)) ## prune down to only unique branches
-
-        reduced_tree.Objects=sorted([k for k in embedding if k.index!='Root'],key=lambda x:x.height) ## assign branches that are kept to new tree's Objects
-        reduced_tree.root=[k for k in embedding if k.index=='Root'][0]
-        # reduced_tree.tipMap=self.tipMap
+                if cur_b is not None or (len(path)>0 and path[-1] is self.root): ## path belongs to this tree
+                    embedding.update(dict.fromkeys(path))
+                    break
 
-        for k in reduced_tree.Objects: ## iterate through reduced tree
-            if k.branchType=='node': ## node
-                ## only keep children that are present in lineage traceback
-                k.children = [c for c in k.children if c in embedding]
+        kept=[k for k in embedding if k is not self.root]
+        copies=self.copyBranches([self.root]+kept,view=view) ## only keeps children that are present in lineage traceback
+        reduced_tree=tree() ## new tree object
+        reduced_tree.Objects=sorted([copies[k] for k in kept],key=lambda x:x.height) ## assign branches that are kept to new tree's Objects
+        reduced_tree.root=copies[self.root]
+        reduced_tree.tipMap=self.tipMap if view==True or self.tipMap is None else dict(self.tipMap)
 
-        reduced_tree.traverse_tree() ## traverse
-        reduced_tree.sortBranches() ## sort
+        reduced_tree.markDirty(reduced_tree.root,subtree=True,sort=True) ## traverse and sort once it's looked at
 
         return reduced_tree ## return new tree
 
-def make_tree(data,ll,verbose=False):
+    def flatten(self):
+        """
+        Compact, picklable representation of the tree as a dictionary of flat lists, one entry per branch in pre-order.
+        The first entry is the root, parents are given as positions in the lists (-1 for the root).
+        Unlike the tree itself this has no parent references, so it is cheap to send between processes.
+        Rebuild the tree with unflatten(). Collapsed clades are not supported: uncollapse them first, or flatten the tree before collapsing.
+        """
+        flat={'branchType':[],'index':[],'parent':[],'length':[],'height':[],'absoluteTime':[],'numName':[],'name':[],'traits':[]}
+        stack=[(self.root,-1)]
+        while len(stack)>0:
+            k,parent=stack.pop()
+            if isinstance(k,clade):
+                raise ValueError('Cannot flatten or save a tree with collapsed clade %s, uncollapse it first (uncollapseSubtree) or save the tree before collapsing'%(k.name))
+            position=len(flat['index'])
+            flat['branchType'].append(k.branchType)
+            flat['index'].append(k.index)
+            flat['parent'].append(parent)
+            flat['length'].append(k.length)
+            flat['height'].append(k.height)
+            flat['absoluteTime'].append(k.absoluteTime)
+            flat['traits'].append(k.traits)
+            if k.branchType=='leaf':
+                flat['numName'].append(k.numName)
+                flat['name'].append(k.name)
+            else:
+                flat['numName'].append(None)
+                flat['name'].append(None)
+                stack+=[(ch,position) for ch in reversed(k.children)] ## reversed so that children are visited in order
+        flat['treeHeight']=self.treeHeight
+        return flat
+
+    def save_binary(self,path,source=None):
+        """
+        Write the tree to a compact binary file that load_binary() reads back through memory maps, without any parsing.
+        source is stored as is in the file header (see load_binary_header), e.g. to tell which file the tree came from.
+        Trees with collapsed clades cannot be saved (see flatten), a ValueError is raised.
+        """
+        flat=self.flatten()
+        x=[]
+        y=[]
+        stack=[self.root] ## same pre-order as flatten()
+        while len(stack)>0:
+            k=stack.pop()
+            x.append(k.x)
+            y.append(k.y)
+            if k.branchType=='node':
+                stack+=k.children[::-1]
+        _write_binary(path,flat,x,y,self.tipMap,self.ySpan,source)
+
+def unflatten(flat):
+    """ Rebuild a tree object from the output of tree.flatten(). """
+    ll=tree()
+    objects,nodes,leaves=ll._Objects,ll._nodes,ll._leaves ## filled directly, the tree has nothing to bring up to date yet
+    branches=[]
+    for branchType,parent,index,length,height,absoluteTime,numName,name,traits in zip(flat['branchType'],flat['parent'],flat['index'],flat['length'],flat['height'],
+                                                                                     flat['absoluteTime'],flat['numName'],flat['name'],flat['traits']):
+        if parent==-1:
+            k=ll.root
+        elif branchType=='leaf':
+            k=leaf()
+            k.numName=numName
+            k.name=name
+            leaves.append(k)
+        else:
+            k=node()
+            nodes.append(k)
+
+        k.index=index
+        k.length=length
+        k.height=height
+        k.absoluteTime=absoluteTime
+        k.traits=traits if traits is not None else {}
+        if parent!=-1:
+            k.parent=branches[parent]
+            k.parent.children.append(k)
+            objects.append(k)
+        branches.append(k)
+    ll.treeHeight=flat['treeHeight']
+    return ll
+
+def _tip_matrix(ll,tips,numName,attr,patristic,dtype,memmap,chunkSize):
     """
-    data is a tree string, ll (LL) is an (empty?) instance of a tree object
+    Fills a tip by tip matrix with the value of attr at each pair's common ancestor (or the patristic distance derived from heights).
+    With tips ranked in pre-order the tips of every node are contiguous, so every pair is set exactly once by a block assignment
+    at its common ancestor, between the tips of one child and those of its later siblings.
+    """
+    index=ll.getLCAIndex()
+    order=index.order
+    if tips is None:
+        tips=ll.leaves
+    lookup=index.numName if numName==True else index.name
+    positions=[index.position[k] if isinstance(k,(leaf,clade)) else lookup[k] for k in tips]
+    value=np.array([k.height if attr=='height' else k.absoluteTime for k in order],dtype=np.float64)
+
+    lo=index.tipStart ## tips of each branch span ranks [lo,hi) in pre-order
+    hi=index.tipEnd
+
+    n=len(positions)
+    ranks=lo[positions]
+    sort=np.argsort(ranks,kind='stable') ## rows and columns are filled in pre-order and rearranged afterwards
+    starts=np.searchsorted(ranks[sort],lo) ## branch tips among the requested ones, in sorted order
+    ends=np.searchsorted(ranks[sort],hi)
+    identity=bool(np.all(sort==np.arange(n)))
+    unsort=np.argsort(sort)
+    tipValue=value[positions]
+
+    if memmap is None:
+        out=np.empty((n,n),dtype=dtype)
+    else:
+        out=np.lib.format.open_memmap(memmap,mode='w+',dtype=dtype,shape=(n,n))
+
+    for s0 in range(0,n,chunkSize):
+        s1=min(n,s0+chunkSize)
+        block=np.empty((s1-s0,n),dtype=np.float64)
+        for i in np.nonzero((starts<s1)&(ends>s0)&(ends>starts))[0]:
+            k=order[i]
+            if k.branchType=='leaf': ## a tip with itself, or with repeats of itself
+                block[max(starts[i],s0)-s0:min(ends[i],s1)-s0,starts[i]:ends[i]]=value[i]
+                continue
+            for c,child in enumerate(k.children[:-1]):
+                a=starts[index.position[child]]
+                b=ends[index.position[child]]
+                if a==b: ## no requested tips down this child
+                    continue
+                if a<s1 and b>s0: ## rows of this child, columns of later siblings
+                    block[max(a,s0)-s0:min(b,s1)-s0,b:ends[i]]=value[i]
+                if b<s1 and ends[i]>s0: ## and the other way round
+                    block[max(b,s0)-s0:min(ends[i],s1)-s0,a:b]=value[i]
+
+        if patristic==True:
+            rows=tipValue[sort[s0:s1]]
+            block=rows[:,None]+tipValue[sort][None,:]-2*block
+
+        if identity==True:
+            out[s0:s1]=block
+        else:
+            out[sort[s0:s1]]=block[:,unsort]
+
+    if memmap is not None:
+        out.flush()
+    return out
+
+class _flatCursor: ## stands in for the current branch while make_tree fills a _flatBuilder
+    __slots__=('builder','position')
+    def __init__(self,builder,position):
+        self.builder=builder
+        self.position=position
+
+    @property
+    def traits(self):
+        traits=self.builder.flat['traits']
+        if traits[self.position] is None: ## trait dictionaries are only created for annotated branches
+            traits[self.position]={}
+        return traits[self.position]
+
+    @property
+    def length(self):
+        return self.builder.flat['length'][self.position]
+
+    @length.setter
+    def length(self,value):
+        self.builder.flat['length'][self.position]=value
+
+    @property
+    def parent(self):
+        return _flatCursor(self.builder,self.builder.flat['parent'][self.position])
+
+class _flatBuilder: ## receives make_tree output directly in the flat form of tree.flatten(), without creating node and leaf objects
+    def __init__(self):
+        self.flat={'branchType':['node'],'index':['Root'],'parent':[-1],'length':[0.0],'height':[0.0],'absoluteTime':[None],
+                   'numName':[None],'name':[None],'traits':[None],'treeHeight':0}
+        self.cur_node=_flatCursor(self,0)
+
+    def add_branch(self,branchType,i,length,numName):
+        """ Append a branch below the current branch and make it current. """
+        flat=self.flat
+        position=len(flat['index'])
+        flat['branchType'].append(branchType)
+        flat['index'].append(i)
+        flat['parent'].append(self.cur_node.position)
+        flat['length'].append(length)
+        flat['height'].append(None)
+        flat['absoluteTime'].append(None)
+        flat['numName'].append(numName)
+        flat['name'].append(None)
+        flat['traits'].append(None)
+        self.cur_node=_flatCursor(self,position)
+
+    def add_node(self,i):
+        self.add_branch('node',i,0.0,None) ## same defaults as the node class
+
+    def add_leaf(self,i,name):
+        self.add_branch('leaf',i,None,name) ## same defaults as the leaf class
+
+def make_flat_tree(data,verbose=False):
+    """ Parse a tree string straight into the flat form of tree.flatten(), without building node and leaf objects. """
+    builder=_flatBuilder()
+    make_tree(data,builder,verbose=verbose)
+    return builder.flat
+
+def make_array_tree(data,verbose=False):
+    """ Parse a tree string straight into an arrayTree. """
+    ll=arrayTree(make_flat_tree(data,verbose=verbose))
+    ll.traverse_tree()
+    return ll
+
+def _float_column(values):
+    """ numpy float array from a list of floats, with NaN for None. """
+    return np.array([np.nan if v is None else v for v in values],dtype=np.float64)
+
+class _arrayTraits(MutableMapping): ## trait dictionary of an arrayBranch, reading and writing the tree's trait columns
+    __slots__=('tree','position')
+    def __init__(self,tree,position):
+        self.tree=tree
+        self.position=position
+
+    def __getitem__(self,key):
+        column=self.tree.traits.get(key)
+        if column is None or column[1][self.position]==False:
+            raise KeyError(key)
+        value=column[0][self.position]
+        return float(value) if column[0].dtype==np.float64 else value
+
+    def __setitem__(self,key,value):
+        self.tree.setTrait(self.position,key,value)
+
+    def __delitem__(self,key):
+        column=self.tree.traits.get(key)
+        if column is None or column[1][self.position]==False:
+            raise KeyError(key)
+        column[1][self.position]=False
+
+    def __iter__(self):
+        return iter([key for key,column in self.tree.traits.items() if column[1][self.position]])
+
+    def __len__(self):
+        return sum([1 for column in self.tree.traits.values() if column[1][self.position]])
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def _array_property(name):
+    """ Property reading and writing one entry of an arrayTree column, with None standing in for NaN. """
+    def fget(self):
+        value=getattr(self.tree,name)[self.position]
+        return None if np.isnan(value) else float(value)
+    def fset(self,value):
+        getattr(self.tree,name)[self.position]=np.nan if value is None else value
+    return property(fget,fset)
+
+class arrayBranch: ## lightweight view onto one branch of an arrayTree, behaves like a node or leaf object
+    __slots__=('tree','position')
+    def __init__(self,tree,position):
+        self.tree=tree
+        self.position=position ## position of the branch in the arrayTree's columns
+
+    length=_array_property('length')
+    height=_array_property('height')
+    absoluteTime=_array_property('absoluteTime')
+    x=_array_property('x')
+    y=_array_property('y')
+
+    @property
+    def branchType(self):
+        return 'leaf' if self.tree.isLeaf[self.position] else 'node'
+
+    @property
+    def index(self):
+        return 'Root' if self.position==0 else int(self.tree.index[self.position])
+
+    @property
+    def parent(self):
+        parent=self.tree.parent[self.position]
+        return None if parent==-1 else arrayBranch(self.tree,int(parent))
+
+    @property
+    def children(self):
+        return [arrayBranch(self.tree,i) for i in self.tree.childPositions(self.position)]
+
+    @property
+    def numName(self):
+        return self.tree.numName[self.position]
+
+    @property
+    def name(self):
+        return self.tree.name[self.position]
+
+    @name.setter
+    def name(self,value):
+        self.tree.name[self.position]=value
+
+    @property
+    def numChildren(self):
+        return int(self.tree.numChildren[self.position])
+
+    @property
+    def leaves(self):
+        """ Sorted list of names of tips descended from this branch, made on request. """
+        return sorted([self.tree.numName[i] for i in self.tree.tipPositions(self.position)])
+
+    @property
+    def traits(self):
+        return _arrayTraits(self.tree,self.position)
+
+    def __eq__(self,other):
+        return isinstance(other,arrayBranch) and other.tree is self.tree and other.position==self.position
+
+    def __hash__(self):
+        return hash((id(self.tree),self.position))
+
+    def __repr__(self):
+        return '<arrayBranch %s %s>'%(self.branchType,self.index)
+
+class arrayTree: ## tree class storing topology and branch attributes as numpy columns, one entry per branch in pre-order
+    def __init__(self,flat):
+        """ Build from the flat form returned by tree.flatten() or make_flat_tree(). Entry 0 is the root. """
+        self.parent=np.array(flat['parent'],dtype=np.int64) ## position of each branch's parent, -1 for the root
+        self.isLeaf=np.array([b=='leaf' for b in flat['branchType']],dtype=bool)
+        self.index=np.array([-1]+flat['index'][1:],dtype=np.int64) ## index of each branch in the tree string, -1 for the root
+        self.length=_float_column(flat['length'])
+        self.height=_float_column(flat['height'])
+        self.absoluteTime=_float_column(flat['absoluteTime'])
+        self.numName=list(flat['numName'])
+        self.name=list(flat['name'])
+        self.x=np.full(len(self.parent),np.nan)
+        self.y=np.full(len(self.parent),np.nan)
+        self.traits={} ## trait name: (values, present) columns
+        for position,traits in enumerate(flat['traits']):
+            if traits:
+                for key,value in traits.items():
+                    self.setTrait(position,key,value)
+        self.tipMap=None
+        self.treeHeight=flat['treeHeight']
+        self.ySpan=0.0
+        self.update_topology()
+
+    @classmethod
+    def fromColumns(cls,parent,isLeaf,index,length,height,absoluteTime,numName,name,traits=None,treeHeight=0.0):
+        """ Build from numpy columns in pre-order, without copying them (load_binary hands over memory maps). """
+        ll=cls.__new__(cls)
+        ll.parent=parent
+        ll.isLeaf=isLeaf
+        ll.index=index
+        ll.length=length
+        ll.height=height
+        ll.absoluteTime=absoluteTime
+        ll.numName=numName
+        ll.name=name
+        ll.x=np.full(len(parent),np.nan)
+        ll.y=np.full(len(parent),np.nan)
+        ll.traits=traits if traits is not None else {}
+        ll.tipMap=None
+        ll.treeHeight=treeHeight
+        ll.ySpan=0.0
+        ll.update_topology()
+        return ll
+
+    def update_topology(self):
+        """ Recompute child and sibling links, subtree ranges and tip counts from the parent column. """
+        n=len(self.parent)
+        self.firstChild=np.full(n,-1,dtype=np.int64)
+        self.nextSibling=np.full(n,-1,dtype=np.int64)
+        kids=np.argsort(self.parent[1:],kind='stable')+1 ## children grouped by parent, in order within each group
+        kid_parents=self.parent[kids]
+        same=kid_parents[1:]==kid_parents[:-1]
+        self.nextSibling[kids[:-1][same]]=kids[1:][same]
+        first=np.concatenate([[True],~same]) if len(kids)>0 else np.zeros(0,dtype=bool)
+        self.firstChild[kid_parents[first]]=kids[first]
+
+        end=list(range(1,n+1)) ## subtree of branch i occupies positions [i,end[i]) in pre-order
+        parent=self.parent.tolist()
+        for i in range(n-1,0,-1):
+            if end[i]>end[parent[i]]:
+                end[parent[i]]=end[i]
+        self.end=np.array(end,dtype=np.int64)
+
+        tipsBefore=np.concatenate([[0],np.cumsum(self.isLeaf)]) ## number of tips before each position
+        self.numChildren=tipsBefore[self.end]-tipsBefore[np.arange(n)]
+
+    def setTrait(self,position,key,value):
+        """ Set trait `key` of the branch at `position`, creating or widening the column as needed. """
+        n=len(self.parent)
+        if key not in self.traits:
+            dtype=np.float64 if isinstance(value,float) else object
+            self.traits[key]=(np.full(n,np.nan) if dtype==np.float64 else np.full(n,None,dtype=object),np.zeros(n,dtype=bool))
+        values,present=self.traits[key]
+        if values.dtype==np.float64 and not isinstance(value,float): ## column can no longer be stored as floats
+            values=values.astype(object)
+            values[~present]=None
+            self.traits[key]=(values,present)
+        values[position]=value
+        present[position]=True
+
+    def childPositions(self,position):
+        """ Positions of the children of the branch at `position`, in order. """
+        children=[]
+        child=self.firstChild[position]
+        while child!=-1:
+            children.append(int(child))
+            child=self.nextSibling[child]
+        return children
+
+    def tipPositions(self,position):
+        """ Positions of the tips descended from the branch at `position`, in traversal order. """
+        return np.flatnonzero(self.isLeaf[position:self.end[position]])+position
+
+    @property
+    def root(self):
+        return arrayBranch(self,0)
+
+    @property
+    def Objects(self):
+        """ Views of all branches, made on request. """
+        return [arrayBranch(self,i) for i in range(1,len(self.parent))]
+
+    @property
+    def nodes(self):
+        return [arrayBranch(self,int(i)) for i in np.flatnonzero(~self.isLeaf[1:])+1]
+
+    @property
+    def leaves(self):
+        return [arrayBranch(self,int(i)) for i in np.flatnonzero(self.isLeaf)]
+
+    def traverse_tree(self):
+        """ Set heights of all branches and the tree height. """
+        height=self.height
+        height[0]=0.0 if np.isnan(height[0]) else height[0]
+        parent=self.parent.tolist()
+        length=self.length.tolist()
+        heights=height.tolist()
+        for i in range(1,len(parent)): ## parents come before their children in pre-order
+            heights[i]=heights[parent[i]]+length[i]
+        self.height=np.array(heights,dtype=np.float64)
+        self.treeHeight=float(self.height[self.isLeaf].max()) if self.isLeaf.any() else 0.0
+
+    def renameTips(self,d):
+        """ Give each tip its correct label using a dictionary. """
+        self.lookup=None
+        if self.tipMap!=None:
+            d=self.tipMap
+        for i in np.flatnonzero(self.isLeaf):
+            self.name[i]=d[self.numName[i]]
+
+    def setAbsoluteTime(self,date):
+        """ place all branches in absolute time by providing the date of the most recent tip """
+        self.absoluteTime=date-self.treeHeight+self.height
+
+    def reorder(self,order):
+        """ Rearrange all columns so that the branch at position order[j] moves to position j. Order must be a pre-order. """
+        order=np.asarray(order,dtype=np.int64)
+        new_position=np.empty(len(order),dtype=np.int64)
+        new_position[order]=np.arange(len(order))
+        parent=self.parent[order]
+        self.parent=np.where(parent==-1,-1,new_position[parent])
+        for attr in ['isLeaf','index','length','height','absoluteTime','x','y']:
+            setattr(self,attr,getattr(self,attr)[order])
+        self.numName=[self.numName[i] for i in order]
+        self.name=[self.name[i] for i in order]
+        self.traits={key:(values[order],present[order]) for key,(values,present) in self.traits.items()}
+        self.update_topology()
+
+    def sortBranches(self,descending=True):
+        """ Sort descendants of each node, the same way as tree.sortBranches(). """
+        modifier=-1 if descending==True else 1
+        length=self.length.tolist()
+        numChildren=self.numChildren.tolist()
+        isLeaf=self.isLeaf.tolist()
+        order=[]
+        stack=[0]
+        while len(stack)>0:
+            i=stack.pop()
+            order.append(i)
+            if isLeaf[i]==False:
+                children=self.childPositions(i)
+                nodes=sorted([c for c in children if isLeaf[c]==False],key=lambda q:(-numChildren[q]*modifier,length[q]*modifier))
+                leaves=sorted([c for c in children if isLeaf[c]],key=lambda q:length[q]*modifier)
+                children=nodes+leaves if modifier==1 else leaves+nodes
+                stack+=children[::-1]
+        self.reorder(order)
+        self.drawTree()
+
+    def drawTree(self):
+        """ Find x and y coordinates of each branch. Tips are spaced one unit apart in traversal order. """
+        n=len(self.parent)
+        tips=np.flatnonzero(self.isLeaf)
+        y=np.full(n,np.nan)
+        y[tips]=len(tips)-np.arange(len(tips))
+        y_list=y.tolist()
+        isLeaf=self.isLeaf.tolist()
+        firstChild=self.firstChild.tolist()
+        nextSibling=self.nextSibling.tolist()
+        for i in range(n-1,0,-1): ## children come after their parents in pre-order, so walk backwards
+            if isLeaf[i]==False:
+                total=0.0
+                count=0
+                child=firstChild[i]
+                while child!=-1: ## internal branch is in the middle of the vertical bar
+                    total+=y_list[child]
+                    count+=1
+                    child=nextSibling[child]
+                if count>0:
+                    y_list[i]=total/count
+        self.y=np.array(y_list,dtype=np.float64)
+        self.y[0]=np.nan ## the root is not drawn
+        self.x=self.height.copy()
+        self.x[0]=np.nan
+        self.ySpan=float(len(tips))
+
+    def flatten(self):
+        """ The tree in the flat form used by tree.flatten(). """
+        def to_list(values):
+            return [None if np.isnan(v) else v for v in values.tolist()]
+        n=len(self.parent)
+        traits=[None]*n
+        for key,(values,present) in self.traits.items():
+            for i in np.flatnonzero(present):
+                if traits[i] is None:
+                    traits[i]={}
+                traits[i][key]=float(values[i]) if values.dtype==np.float64 else values[i]
+        return {'branchType':['leaf' if b else 'node' for b in self.isLeaf.tolist()],
+                'index':['Root']+self.index[1:].tolist(),
+                'parent':self.parent.tolist(),
+                'length':to_list(self.length),
+                'height':to_list(self.height),
+                'absoluteTime':to_list(self.absoluteTime),
+                'numName':list(self.numName),
+                'name':list(self.name),
+                'traits':traits,
+                'treeHeight':self.treeHeight}
+
+    def toTree(self):
+        """ Convert to a regular tree of node and leaf objects. """
+        ll=unflatten(self.flatten())
+        ll.tipMap=self.tipMap
+        return ll
+
+    def save_binary(self,path,source=None):
+        """ Write the tree to a compact binary file, see tree.save_binary(). """
+        _write_binary(path,self.flatten(),self.x.tolist(),self.y.tolist(),self.tipMap,self.ySpan,source)
+
+## binary tree files: magic line, header length, JSON header, then 64-byte aligned numpy columns in pre-order
+_binary_magic=b'BALTIC-BINARY-1\n'
+_binary_align=64
+
+def _string_refs(values,strings,lookup):
+    """ Positions of strings in a string table (-1 for None), adding new strings to the table. """
+    refs=np.full(len(values),-1,dtype=np.int64)
+    for i,value in enumerate(values):
+        if value is not None:
+            if value not in lookup:
+                lookup[value]=len(strings)
+                strings.append(value)
+            refs[i]=lookup[value]
+    return refs
+
+def _write_binary(path,flat,x,y,tipMap,ySpan,source):
+    """ Write the flat form of a tree (see tree.flatten) plus layout to a binary file. """
+    n=len(flat['parent'])
+    strings=[]
+    lookup={}
+    columns={'parent':np.array(flat['parent'],dtype=np.int64),
+             'isLeaf':np.array([b=='leaf' for b in flat['branchType']],dtype=bool),
+             'length':_float_column(flat['length']),
+             'height':_float_column(flat['height']),
+             'absoluteTime':_float_column(flat['absoluteTime']),
+             'x':_float_column(x),
+             'y':_float_column(y),
+             'numName':_string_refs(flat['numName'],strings,lookup),
+             'name':_string_refs(flat['name'],strings,lookup)}
+
+    indices=flat['index'][1:]
+    if all([isinstance(i,int) and not isinstance(i,bool) for i in indices]): ## indices from make_tree are positions in the tree string
+        indexKind='int'
+        columns['index']=np.array([-1]+indices,dtype=np.int64)
+    else:
+        indexKind='json'
+        columns['index']=_string_refs([json.dumps(i) for i in flat['index']],strings,lookup)
+
+    entries={} ## trait name: positions and values
+    for position,traits in enumerate(flat['traits']):
+        if traits:
+            for key,value in traits.items():
+                entries.setdefault(key,([],[]))
+                entries[key][0].append(position)
+                entries[key][1].append(value)
+    traitKinds=[]
+    for t,(key,(positions,values)) in enumerate(entries.items()):
+        present=np.zeros(n,dtype=bool)
+        present[positions]=True
+        if all([isinstance(v,float) for v in values]):
+            kind='float'
+            column=np.full(n,np.nan)
+            column[positions]=values
+        elif all([isinstance(v,int) and not isinstance(v,bool) and -2**63<=v<2**63 for v in values]):
+            kind='int'
+            column=np.zeros(n,dtype=np.int64)
+            column[positions]=values
+        elif all([isinstance(v,str) for v in values]):
+            kind='str'
+            column=np.full(n,-1,dtype=np.int64)
+            column[positions]=_string_refs(values,strings,lookup)
+        else: ## lists, sets of states and anything else go through JSON
+            kind='json'
+            column=np.full(n,-1,dtype=np.int64)
+            column[positions]=_string_refs([json.dumps(v) for v in values],strings,lookup)
+        traitKinds.append([key,kind])
+        columns['trait%d'%(t)]=column
+        columns['present%d'%(t)]=present
+
+    encoded=[s.encode('utf-8') for s in strings]
+    columns['stringOffsets']=np.cumsum([0]+[len(s) for s in encoded],dtype=np.int64)
+    columns['strings']=np.frombuffer(b''.join(encoded),dtype=np.uint8)
+
+    arrays={}
+    offset=0
+    for key,values in columns.items():
+        arrays[key]={'dtype':values.dtype.str,'shape':list(values.shape),'offset':offset}
+        offset+=-(-values.nbytes//_binary_align)*_binary_align
+    header=json.dumps({'version':1,'indexKind':indexKind,'rootIndex':flat['index'][0],'traits':traitKinds,
+                       'treeHeight':flat['treeHeight'],'ySpan':ySpan,'tipMap':tipMap,'source':source,'arrays':arrays}).encode('utf-8')
+    start=len(_binary_magic)+8+len(header)
+    with open(path,'wb') as handle:
+        handle.write(_binary_magic)
+        handle.write(struct.pack('<Q',len(header)))
+        handle.write(header)
+        handle.write(b'\0'*(-(-start//_binary_align)*_binary_align-start))
+        for key,values in columns.items():
+            data=np.ascontiguousarray(values).tobytes()
+            handle.write(data)
+            handle.write(b'\0'*(-(-len(data)//_binary_align)*_binary_align-len(data)))
+
+def load_binary_header(path):
+    """ Header of a binary tree file written by save_binary(), as a dictionary. Returns None if the file is not one. """
+    with open(path,'rb') as handle:
+        if handle.read(len(_binary_magic))!=_binary_magic:
+            return None
+        size=struct.unpack('<Q',handle.read(8))[0]
+        header=json.loads(handle.read(size).decode('utf-8'))
+    header['start']=-(-(len(_binary_magic)+8+size)//_binary_align)*_binary_align
+    return header
+
+def load_binary(path,arrays=False):
+    """
+    Load a tree written by save_binary(). Columns are memory mapped rather than parsed.
+    Returns a tree of node and leaf objects (not traversed), or an arrayTree working directly on the memory maps if arrays=True.
+    """
+    header=load_binary_header(path)
+    assert header is not None,'Not a baltic binary tree file: %s'%(path)
+    columns={}
+    for key,spec in header['arrays'].items():
+        shape=tuple(spec['shape'])
+        if int(np.prod(shape))==0: ## zero-length memory maps are not allowed
+            columns[key]=np.zeros(shape,dtype=np.dtype(spec['dtype']))
+        else: ## copy-on-write, so trees can be modified without touching the file
+            columns[key]=np.memmap(path,dtype=np.dtype(spec['dtype']),mode='c',offset=header['start']+spec['offset'],shape=shape)
+
+    blob=columns['strings'].tobytes()
+    offsets=columns['stringOffsets'].tolist()
+    strings=[blob[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets)-1)]
+    def decode(refs,kind='str'):
+        if kind=='json':
+            return [None if r==-1 else json.loads(strings[r]) for r in refs.tolist()]
+        return [None if r==-1 else strings[r] for r in refs.tolist()]
+
+    n=len(columns['parent'])
+    if header['indexKind']=='int':
+        index=[header['rootIndex']]+columns['index'][1:].tolist()
+    else:
+        index=decode(columns['index'],'json')
+
+    if arrays==True:
+        traits={}
+        for t,(key,kind) in enumerate(header['traits']):
+            values,present=columns['trait%d'%(t)],columns['present%d'%(t)]
+            if kind!='float':
+                values=np.array(values.tolist() if kind=='int' else decode(values,kind),dtype=object)
+                values[~present]=None
+            traits[key]=(values,present)
+        ll=arrayTree.fromColumns(columns['parent'],columns['isLeaf'],columns['index'] if header['indexKind']=='int' else np.full(n,-1,dtype=np.int64),
+                                 columns['length'],columns['height'],columns['absoluteTime'],decode(columns['numName']),decode(columns['name']),
+                                 traits,header['treeHeight'])
+        ll.x=columns['x']
+        ll.y=columns['y']
+    else:
+        traits=[None]*n
+        for t,(key,kind) in enumerate(header['traits']):
+            present=np.flatnonzero(columns['present%d'%(t)]).tolist()
+            values=columns['trait%d'%(t)]
+            if kind=='float' or kind=='int':
+                values=values[present].tolist()
+            else:
+                values=decode(values[present],kind)
+            for position,value in zip(present,values):
+                if traits[position] is None:
+                    traits[position]={}
+                traits[position][key]=value
+
+        def to_list(values):
+            return [None if v!=v else v for v in values.tolist()] ## NaN stands in for None
+        flat={'branchType':['leaf' if b else 'node' for b in columns['isLeaf'].tolist()],
+              'index':index,
+              'parent':columns['parent'].tolist(),
+              'length':to_list(columns['length']),
+              'height':to_list(columns['height']),
+              'absoluteTime':to_list(columns['absoluteTime']),
+              'numName':decode(columns['numName']),
+              'name':decode(columns['name']),
+              'traits':traits,
+              'treeHeight':header['treeHeight']}
+        ll=unflatten(flat)
+        for k,x,y in zip([ll.root]+ll.Objects,to_list(columns['x']),to_list(columns['y'])):
+            k.x=x
+            k.y=y
+
+    ll.tipMap=header['tipMap']
+    ll.ySpan=header['ySpan']
+    return ll
+
+## compiled once and matched in place with pattern.match(data,pos), so the tree string is never sliced
+_tip_regex=re.compile('([\'\"]*)([A-Za-z\_\-\|\.0-9\?\/]+)([\'\"]?)') ## tip names, optionally quoted
+_multitype_regex=re.compile('([0-9]+)\[') ## multitype tree singletons, following a closing bracket
+_comment_regex=re.compile('\:*\[&([A-Za-z\_\-{}\,0-9\.\%=\"\+!#]+)\]') ## MCC comments
+_label_regex=re.compile('([A-Za-z\_\-0-9\.]+)[\:\;]') ## old school node labels
+_length_regex=re.compile('\:*([0-9\.\-Ee]+)') ## branch lengths without comments
+
+def parse_comment(comment,cur_node):
+    """ Assign the annotations found in an MCC comment (without the enclosing [& and ]) to the traits of cur_node. """
+    numerics=re.findall('[A-Za-z\_\.0-9]+=[0-9\-Ee\.]+',comment) ## find all entries that have values as floats
+    strings=re.findall('[A-Za-z\_\.0-9]+=["|\']*[A-Za-z\_0-9\.\+]+["|\']*',comment) ## strings
+    treelist=re.findall('[A-Za-z\_\.0-9]+={[A-Za-z\_,{}0-9\.]+}',comment) ## complete history logged robust counting (MCMC trees)
+    sets=re.findall('[A-Za-z\_\.0-9\%]+={[A-Za-z\.\-0-9eE,\"\_]+}',comment) ## sets and ranges
+    figtree=re.findall('\![A-Za-z]+=[A-Za-z0-9#]+',comment)
+
+    for vals in strings:
+        tr,val=vals.split('=')
+        if '+' in val:
+            val=val.split('+')[0] ## DO NOT ALLOW EQUIPROBABLE DOUBLE ANNOTATIONS (which are in format "A+B") - just get the first one
+        cur_node.traits[tr]=val.strip('"')
+
+    for vals in numerics: ## assign all parsed annotations to traits of current branch
+        tr,val=vals.split('=') ## split each value by =, left side is name, right side is value
+        cur_node.traits[tr]=float(val)
+
+    for val in treelist:
+        tr,val=val.split('=')
+        microcerberus=re.findall('{([0-9]+,[0-9\.\-e]+,[A-Z]+,[A-Z]+)}',val)
+        cur_node.traits[tr]=[]
+        for val in microcerberus:
+            codon,timing,start,end=val.split(',')
+            cur_node.traits[tr].append((int(codon),float(timing),start,end))
+
+    for vals in sets:
+        tr,val=vals.split('=')
+        if 'set' in tr:
+            cur_node.traits[tr]=[]
+            for v in val[1:-1].split(','):
+                if 'set.prob' in tr:
+                    cur_node.traits[tr].append(float(v))
+                else:
+                    cur_node.traits[tr].append(v.strip('"'))
+        elif 'range' in tr or 'HPD' in tr:
+            cur_node.traits[tr]=list(map(float,val[1:-1].split(',')))
+        else:
+            print('some other trait: %s'%(vals))
+
+    if len(figtree)>0:
+        print('FigTree comment found, ignoring')
+
+def make_tree(data,ll,verbose=False,legacy=False):
+    """
+    data is a tree string, ll (LL) is an (empty?) instance of a tree object.
+    Walks the tree string once, matching each token in place. Setting legacy=True
+    uses the original regex-per-position parser instead, e.g. to check that both agree.
+    """
+    if legacy==True:
+        return make_tree_legacy(data,ll,verbose=verbose)
+
+    i=0 ## is an adjustable index along the tree string, it is incremented to advance through the string
+    stored_i=None ## store the i at the end of the loop, to make sure we haven't gotten stuck somewhere in an infinite loop
+    n=len(data)
+
+    while i < n: ## while there's characters left in the tree string - loop away
+        if stored_i == i and verbose==True:
+            print('%d >%s<'%(i,data[i]))
+
+        assert (stored_i != i),'\nTree string unparseable\nStopped at >>%s<<\nstring region looks like this: %s'%(data[i],data[i:i+5000])
+        ## make sure that you've actually parsed something last time, if not - there's something unexpected in the tree string
+        stored_i=i ## store i for later
+
+        if data[i] == '(': ## look for new nodes
+            if verbose==True:
+                print('%d adding node'%(i))
+            ll.add_node(i) ## add node to current node in tree ll
+            i+=1
+
+        previous=data[i-1] if i>0 else ''
+        if previous=='(' or previous==',': ## tips only ever follow the start of a node or a bifurcation
+            cerberus=_tip_regex.match(data,i)
+            if cerberus is not None:
+                if verbose==True:
+                    print('%d adding leaf %s'%(i,cerberus.group(2)))
+                ll.add_leaf(i,cerberus.group(2)) ## add tip
+                i=cerberus.end() ## advance past the tip name and any quotes around it
+        elif previous==')': ## look for multitype tree singletons
+            cerberus=_multitype_regex.match(data,i)
+            if cerberus is not None:
+                if verbose==True:
+                    print('%d adding multitype node %s'%(i,cerberus.group(1)))
+                i+=len(cerberus.group(1))
+
+        cerberus=_comment_regex.match(data,i) ## look for MCC comments
+        if cerberus is not None:
+            if verbose==True:
+                print('%d comment: %s'%(i,cerberus.group(1)))
+            parse_comment(cerberus.group(1),ll.cur_node)
+            i=cerberus.end() ## advance in tree string by however many characters it took to encode labels
+
+        cerberus=_label_regex.match(data,i) ## look for old school node labels
+        if cerberus is not None:
+            if verbose==True:
+                print('old school comment found: %s'%(cerberus.group(1)))
+            ll.cur_node.traits['label']=cerberus.group(1)
+            i=cerberus.end(1)
+
+        microcerberus=_length_regex.match(data,i) ## look for branch lengths without comments
+        if microcerberus is not None:
+            if verbose==True:
+                print('adding branch length (%d) %.6f'%(i,float(microcerberus.group(1))))
+            ll.cur_node.length=float(microcerberus.group(1)) ## set branch length of current node
+            i=microcerberus.end() ## advance in tree string by however many characters it took to encode branch length
+
+        if i < n and (data[i] == ',' or data[i] == ')'): ## look for bifurcations or clade ends
+            i+=1 ## advance in tree string
+            ll.cur_node=ll.cur_node.parent
+
+        if i < n and data[i] == ';': ## look for string end
+            break ## end loop
+
+def make_tree_legacy(data,ll,verbose=False):
+    """
+    Original parser, kept for comparison with make_tree. Runs every pattern against a slice of the
+    remaining tree string at each step, so takes quadratic time on long tree strings.
     """
     i=0 ## is an adjustable index along the tree string, it is incremented to advance through the string
     stored_i=None ## store the i at the end of the loop, to make sure we haven't gotten stuck somewhere in an infinite loop
@@ -834,47 +2183,7 @@ def make_tree(data,ll,verbose=False):
         if cerberus is not None:
             if verbose==True:
                 print('%d comment: %s'%(i,cerberus.group(2)))
-            comment=cerberus.group(2)
-            numerics=re.findall('[A-Za-z\_\.0-9]+=[0-9\-Ee\.]+',comment) ## find all entries that have values as floats
-            strings=re.findall('[A-Za-z\_\.0-9]+=["|\']*[A-Za-z\_0-9\.\+]+["|\']*',comment) ## strings
-            treelist=re.findall('[A-Za-z\_\.0-9]+={[A-Za-z\_,{}0-9\.]+}',comment) ## complete history logged robust counting (MCMC trees)
-            sets=re.findall('[A-Za-z\_\.0-9\%]+={[A-Za-z\.\-0-9eE,\"\_]+}',comment) ## sets and ranges
-            figtree=re.findall('\![A-Za-z]+=[A-Za-z0-9#]+',comment)
-
-            for vals in strings:
-                tr,val=vals.split('=')
-                if '+' in val:
-                    val=val.split('+')[0] ## DO NOT ALLOW EQUIPROBABLE DOUBLE ANNOTATIONS (which are in format "A+B") - just get the first one
-                ll.cur_node.traits[tr]=val.strip('"')
-
-            for vals in numerics: ## assign all parsed annotations to traits of current branch
-                tr,val=vals.split('=') ## split each value by =, left side is name, right side is value
-                ll.cur_node.traits[tr]=float(val)
-
-            for val in treelist:
-                tr,val=val.split('=')
-                microcerberus=re.findall('{([0-9]+,[0-9\.\-e]+,[A-Z]+,[A-Z]+)}',val)
-                ll.cur_node.traits[tr]=[]
-                for val in microcerberus:
-                    codon,timing,start,end=val.split(',')
-                    ll.cur_node.traits[tr].append((int(codon),float(timing),start,end))
-
-            for vals in sets:
-                tr,val=vals.split('=')
-                if 'set' in tr:
-                    ll.cur_node.traits[tr]=[]
-                    for v in val[1:-1].split(','):
-                        if 'set.prob' in tr:
-                            ll.cur_node.traits[tr].append(float(v))
-                        else:
-                            ll.cur_node.traits[tr].append(v.strip('"'))
-                elif 'range' in tr or 'HPD' in tr:
-                    ll.cur_node.traits[tr]=map(float,val[1:-1].split(','))
-                else:
-                    print('some other trait: %s'%(vals))
-
-            if len(figtree)>0:
-                print('FigTree comment found, ignoring')
+            parse_comment(cerberus.group(2),ll.cur_node)
 
             i+=len(cerberus.group()) ## advance in tree string by however many characters it took to encode labels
 
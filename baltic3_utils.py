@@ -1,10 +1,16 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from matplotlib.collections import LineCollection
 
 
 import re
+import os
 import copy
 import math
+import random
+import itertools
+import multiprocessing
+from collections import Counter
 import numpy as np
 import pandas as pd
 
@@ -29,13 +35,10 @@ def get_leaf(tree, tipname):
 
     RETURNS
     -------
-    lf: baltic leaf object with name `tipname`
+    lf: baltic leaf object with name `tipname`, or None if there is none. Tips renamed by assigning `k.name` directly,
+    rather than with `tree.renameTips`, are only found after resetting `tree.lookup = None`.
     """
-    lf = None
-    for k in tree.leaves:
-        if k.name == tipname:
-            lf = k
-    return lf
+    return tree.leaf_by_name(tipname)
 
 
 def quick_draw_tree(tree, 
@@ -90,44 +93,42 @@ def quick_draw_tree(tree,
     # ==================== Plot! ====================
     fig,ax = plt.subplots(figsize=(fig_w, fig_h),facecolor='w')
 
-    for k in tree.Objects:
-        x=k.height
-        y=k.y
-
-        xp = k.parent.height
-        if x is None:
-            x = x_offset
-        if xp==None:
-            xp = x + x_offset
-
-        if isinstance(k,bt.leaf) or k.branchType=='leaf':
-            if colour_by != "":
-                # colour only those tips identified in c_dict
-                if k.traits[colour_by] in list(c_dict.keys()):
-                    ax.scatter(x, y, facecolor=c_dict[k.traits[colour_by]], 
-                               edgecolor='none',
-                               s=tip_shape_size, 
-                               zorder=10)
-                    # following Gytis' art style: plot black circles underneath
-                    ax.scatter(x,y,s=tip_shape_size+0.8*tip_shape_size,
-                               facecolor='k',
-                               edgecolor='none',
-                               zorder=9)
-            else:
-                pass
-
-        elif isinstance(k,bt.node) or k.branchType=='node':
-            ax.plot([x,x],
-                    [k.children[-1].y,k.children[0].y],
-                    lw=branch_width,
-                    color=branch_colour,ls='-',zorder=9)
+    # All branches go into a single LineCollection, and tips into one scatter call per colour,
+    # rather than one matplotlib artist per branch.
+    horizontal, vertical, tip_x, tip_y, tip_traits = tree_segments(tree, x_offset=x_offset, trait_name=colour_by)
+    branches = LineCollection(np.concatenate([horizontal, vertical]),
+                              linewidths=branch_width,
+                              colors=branch_colour,
+                              linestyles='-',
+                              zorder=9)
+    ax.add_collection(branches)
+    ax.autoscale_view()
 
-        # Draw horizontal lines
-        ax.plot([xp,x],[y,y],lw=branch_width,color=branch_colour,ls='-',zorder=9)
+    if colour_by != "":
+        # colour only those tips identified in c_dict
+        groups = {}
+        for i, tr in enumerate(tip_traits):
+            if tr in c_dict:
+                groups.setdefault(tr, []).append(i)
+        coloured = np.zeros(len(tip_x), dtype=bool)
+        for val in c_dict:
+            if val in groups:
+                idx = np.array(groups[val])
+                ax.scatter(tip_x[idx], tip_y[idx], facecolor=c_dict[val],
+                           edgecolor='none',
+                           s=tip_shape_size,
+                           zorder=10)
+                coloured[idx] = True
+        if coloured.any():
+            # following Gytis' art style: plot black circles underneath
+            ax.scatter(tip_x[coloured], tip_y[coloured], s=tip_shape_size+0.8*tip_shape_size,
+                       facecolor='k',
+                       edgecolor='none',
+                       zorder=9)
 
     # ==================== Figure Legend ====================
+    labels = [] # for ax.legend()
     if colour_by != "":
-        labels = [] # for ax.legend()
         for c in list(c_dict.keys()):
             labels.append(mpatches.Patch(color=c_dict[c], label=c))
 
@@ -154,6 +155,77 @@ def quick_draw_tree(tree,
     plt.show()
 
 
+def tree_segments(tree, x_offset=0, trait_name=""):
+    """Builds the line segments and tip coordinates needed to draw `tree` as numpy arrays,
+    for plotting with a single LineCollection. Works on regular trees and on `baltic3.arrayTree`.
+    Coordinates follow `quick_draw_tree`: x is the branch height, the root is placed at `x_offset`.
+
+    PARAMS
+    ------
+    tree: baltic tree object, with y coordinates set (e.g. by `sortBranches()`).
+    x_offset: float; x position used for branches without a height, i.e. the root.
+    trait_name: str; optional trait to collect for each tip.
+
+    RETURNS
+    -------
+    horizontal: np array of shape (n_branches, 2, 2); one segment from parent to branch per branch.
+    vertical: np array of shape (n_nodes, 2, 2); one segment spanning the children of each node.
+    tip_x, tip_y: np arrays; tip coordinates.
+    tip_traits: list; value of `trait_name` for each tip, None if missing or no trait was asked for.
+    """
+    if isinstance(tree, bt.arrayTree):
+        branches = np.arange(1, len(tree.parent))
+        x = np.where(np.isnan(tree.height), x_offset, tree.height)
+        xp = tree.height[tree.parent[branches]]
+        xp = np.where(np.isnan(xp), x[branches] + x_offset, xp)
+        x_b = x[branches]
+        y_b = tree.y[branches]
+
+        last_child = np.full(len(tree.parent), -1)
+        ends = branches[tree.nextSibling[branches] == -1]
+        last_child[tree.parent[ends]] = ends
+        nodes = branches[~tree.isLeaf[branches]]
+        nodes = nodes[tree.firstChild[nodes] != -1]
+        node_x = x[nodes]
+        node_y0 = tree.y[last_child[nodes]]
+        node_y1 = tree.y[tree.firstChild[nodes]]
+
+        tips = np.flatnonzero(tree.isLeaf)
+        tip_x, tip_y = x[tips], tree.y[tips]
+        tip_traits = [None]*len(tips)
+        if trait_name in tree.traits:
+            values, present = tree.traits[trait_name]
+            tip_traits = [v if p else None for v, p in zip(values[tips].tolist(), present[tips].tolist())]
+    else:
+        n = len(tree.Objects)
+        x_b = np.empty(n); xp = np.empty(n); y_b = np.empty(n)
+        node_x, node_y0, node_y1 = [], [], []
+        tip_x, tip_y, tip_traits = [], [], []
+        for i, k in enumerate(tree.Objects):
+            x = k.height
+            xp_k = k.parent.height
+            if x is None:
+                x = x_offset
+            if xp_k is None:
+                xp_k = x + x_offset
+            x_b[i], xp[i], y_b[i] = x, xp_k, k.y
+
+            if k.branchType == 'leaf':
+                tip_x.append(x)
+                tip_y.append(k.y)
+                tip_traits.append(k.traits.get(trait_name) if trait_name != "" else None)
+            elif len(k.children) > 0:
+                node_x.append(x)
+                node_y0.append(k.children[-1].y)
+                node_y1.append(k.children[0].y)
+        node_x, node_y0, node_y1 = np.array(node_x, dtype=float), np.array(node_y0, dtype=float), np.array(node_y1, dtype=float)
+        tip_x, tip_y = np.array(tip_x, dtype=float), np.array(tip_y, dtype=float)
+
+    horizontal = np.stack([np.stack([xp, y_b], axis=-1), np.stack([x_b, y_b], axis=-1)], axis=1)
+    vertical = np.stack([np.stack([node_x, node_y0], axis=-1), np.stack([node_x, node_y1], axis=-1)], axis=1)
+    return horizontal.reshape(-1, 2, 2), vertical.reshape(-1, 2, 2), tip_x, tip_y, tip_traits
+
+
 def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_", make_tree_verbose=False):
     """Lifted from the austechia.ipynb (thus the name). 
     This works for BEAST and RAXML trees, or raw newick strings, but not really for treetime or LSD dated trees. 
@@ -235,9 +307,44 @@ def austechia_read_tree(tree_path, date_bool=False, date_pos=-1, date_delim="_",
     return ll
 
 
-def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',treestring_regex='tree [A-Za-z\_]+([0-9]+)',variableDate=True,absoluteTime=True,verbose=False):
+def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%d',treestring_regex='tree [A-Za-z\_]+([0-9]+)',variableDate=True,absoluteTime=True,verbose=False,cache=False):
     """Gytis' original tree-reading function.
+    With cache=True the loaded tree is saved next to the NEXUS file as <tree_path>.baltic (see tree.save_binary), and later
+    calls with the same arguments load that instead of parsing, for as long as the NEXUS file's size and modification time match.
+    The cache holds the tree as loaded; collapse clades after loading, since trees with collapsed clades cannot be saved.
+    A cached load skips parsing but still builds every node and leaf object, so it is only about twice as fast as parsing.
+    For near-zero load times work on `bt.load_binary(tree_path+'.baltic', arrays=True)`, an arrayTree over memory maps.
+    If the cache cannot be written (e.g. a read-only directory) a warning is printed and the parsed tree is returned.
     """
+    if cache==True and isinstance(tree_path,str):
+        cache_path=tree_path+'.baltic'
+        stat=os.stat(tree_path)
+        source={'path':os.path.abspath(tree_path),'size':stat.st_size,'mtime_ns':stat.st_mtime_ns,
+                'args':[tip_regex,date_fmt,treestring_regex,variableDate,absoluteTime]}
+        if os.path.exists(cache_path) and (bt.load_binary_header(cache_path) or {}).get('source')==source:
+            if verbose==True:
+                print('Loading cached tree %s'%(cache_path))
+            ll=bt.load_binary(cache_path)
+            heights=[(k,k.height) for k in [ll.root]+ll.Objects]
+            treeHeight=ll.treeHeight
+            ll.traverse_tree() ## counts tips below nodes
+            for k,height in heights: ## keep heights as saved, re-summing them can differ in the last digits
+                k.height=height
+            ll.treeHeight=treeHeight
+            return ll
+        ll=loadNexus(tree_path,tip_regex=tip_regex,date_fmt=date_fmt,treestring_regex=treestring_regex,variableDate=variableDate,absoluteTime=absoluteTime,verbose=verbose)
+        try:
+            ll.save_binary(cache_path+'.tmp',source=source)
+            os.replace(cache_path+'.tmp',cache_path) ## readers never see a half-written cache
+        except OSError as error:
+            print('WARNING: could not write tree cache %s (%s), continuing without it'%(cache_path,error))
+            if os.path.exists(cache_path+'.tmp'):
+                try:
+                    os.remove(cache_path+'.tmp')
+                except OSError:
+                    pass
+        return ll
+
     tipFlag=False
     tips={}
     tipNum=0
@@ -304,6 +411,496 @@ def loadNexus(tree_path,tip_regex='\|([0-9]+\-[0-9]+\-[0-9]+)',date_fmt='%Y-%m-%
     return ll
 
 
+def iter_nexus_strings(tree_path, tips, burnin=0, thin=1, treestring_regex='tree [A-Za-z\_]+([0-9]+)', verbose=False):
+    """Streams tree strings out of a (multi-tree) NEXUS file, one line at a time.
+    The translate block is parsed into `tips` as it goes past, so by the time the
+    first tree string is yielded `tips` holds the full tip map.
+
+    PARAMS
+    ------
+    tree_path: str or open file handle; path to the NEXUS file.
+    tips: dict; filled in-place with the translate block, {numName: name}.
+    burnin: int; number of trees at the start of the file to discard.
+    thin: int; yield every `thin`-th tree after the burnin.
+    treestring_regex: str; regular expression identifying tree lines.
+    verbose: Boolean; verbosity parameter.
+
+    YIELDS
+    ------
+    tree_string: str; newick string starting from the first '(' of each kept tree line.
+    """
+    assert thin>=1,'thin must be a positive integer'
+    if isinstance(tree_path,str):
+        handle=open(tree_path,'r')
+    else:
+        handle=tree_path
+
+    tipFlag=False
+    tree_idx=0
+    try:
+        for line in handle:
+            l=line.strip('\n')
+
+            cerberus=re.search(treestring_regex,l)
+            if cerberus is not None:
+                if tree_idx>=burnin and (tree_idx-burnin)%thin==0:
+                    if verbose:
+                        print('Identified tree string %d'%(tree_idx))
+                    yield l[l.index('('):]
+                tree_idx+=1
+                tipFlag=False
+                continue
+
+            if tipFlag==True:
+                cerberus=re.search('([0-9]+) ([A-Za-z\-\_\/\.\'0-9 \|?]+)',l)
+                if cerberus is not None:
+                    tips[cerberus.group(1)]=cerberus.group(2).strip('"').strip("'")
+                elif ';' not in l:
+                    print('tip not captured by regex:',l.replace('\t',''))
+
+            if 'translate' in l.lower():
+                tipFlag=True
+            if ';' in l:
+                tipFlag=False
+    finally:
+        if handle is not tree_path:
+            handle.close()
+
+
+def iter_nexus_trees(tree_path, burnin=0, thin=1, treestring_regex='tree [A-Za-z\_]+([0-9]+)', sort_branches=False, verbose=False):
+    """Lazily reads every tree in a multi-tree NEXUS file, e.g. a BEAST posterior `.trees` file.
+    Trees are parsed one at a time as they are requested, so memory use does not grow with
+    the number of trees in the file. The translate block is parsed once and the same
+    tip map is shared by all trees (as `tree.tipMap`).
+
+    Usage:
+    >>> for ll in iter_nexus_trees("posterior.trees", burnin=1000, thin=10):
+    ...     print(ll.treeHeight)
+
+    PARAMS
+    ------
+    tree_path: str or open file handle; path to the NEXUS file.
+    burnin: int; number of trees at the start of the file to discard.
+    thin: int; keep every `thin`-th tree after the burnin.
+    treestring_regex: str; regular expression identifying tree lines. The default matches
+    BEAST's `tree STATE_0 = ...` and `tree TREE1 = ...`.
+    sort_branches: Boolean; if True, sort branches and compute (x, y) coordinates for each tree.
+    Off by default, since posterior summaries rarely need a layout.
+    verbose: Boolean; verbosity parameter.
+
+    YIELDS
+    ------
+    ll: baltic tree object, traversed, with tips renamed if a translate block was present.
+    """
+    tips={}
+    for tree_string in iter_nexus_strings(tree_path, tips, burnin=burnin, thin=thin, treestring_regex=treestring_regex, verbose=verbose):
+        ll=bt.tree()
+        bt.make_tree(tree_string,ll)
+        ll.traverse_tree()
+        if len(tips)>0:
+            ll.tipMap=tips
+            ll.renameTips(tips)
+        if sort_branches:
+            ll.sortBranches()
+        yield ll
+
+
+def flatten_tree_string(tree_string):
+    """Parses a single tree string and returns its compact, picklable form (see `tree.flatten()`).
+    The tree is not traversed, so heights are left as None; they follow from the parents and lengths.
+    Module-level so that it can be handed to a multiprocessing pool.
+    """
+    ll=bt.tree()
+    bt.make_tree(tree_string,ll)
+    return ll.flatten()
+
+
+def parse_trees_parallel(tree_path, workers=None, burnin=0, thin=1, chunksize=16, flat=False,
+                         treestring_regex='tree [A-Za-z\_]+([0-9]+)', verbose=False):
+    """Parses the trees of a multi-tree NEXUS file (e.g. a BEAST posterior) across a pool of worker processes.
+    The file is streamed in the main process, raw tree strings are handed to the workers, and the workers
+    send back the compact `tree.flatten()` form rather than the tree objects themselves.
+    Trees come back in file order. Only a bounded batch of tree strings is in flight at any time.
+
+    For the best scaling keep `flat=True` and work on the flat lists directly; rebuilding full tree objects
+    happens in the main process.
+
+    Usage:
+    >>> for ll in parse_trees_parallel("posterior.trees", workers=8, burnin=1000):
+    ...     print(ll.treeHeight)
+
+    PARAMS
+    ------
+    tree_path: str or open file handle; path to the NEXUS file.
+    workers: int; number of worker processes. Defaults to the number of CPUs.
+    burnin: int; number of trees at the start of the file to discard.
+    thin: int; keep every `thin`-th tree after the burnin.
+    chunksize: int; number of tree strings sent to a worker at a time.
+    flat: Boolean; if True, yield the flat dictionaries instead of rebuilt tree objects.
+    Tip names in the flat form are not translated; use the `tipMap` of a rebuilt tree, or `iter_nexus_strings`.
+    treestring_regex: str; regular expression identifying tree lines.
+    verbose: Boolean; verbosity parameter.
+
+    YIELDS
+    ------
+    ll: baltic tree object (traversed, tips renamed), or its flat dictionary if `flat=True`.
+    """
+    if workers is None:
+        workers=multiprocessing.cpu_count()
+
+    tips={}
+    tree_strings=iter_nexus_strings(tree_path, tips, burnin=burnin, thin=thin, treestring_regex=treestring_regex, verbose=verbose)
+    batch_size=workers*chunksize*4 ## enough to keep every worker busy without reading the whole file into memory
+
+    with multiprocessing.Pool(workers) as pool:
+        while True:
+            batch=list(itertools.islice(tree_strings,batch_size))
+            if len(batch)==0:
+                break
+            for flat_tree in pool.imap(flatten_tree_string,batch,chunksize):
+                if flat:
+                    yield flat_tree
+                else:
+                    ll=bt.unflatten(flat_tree)
+                    ll.traverse_tree()
+                    if len(tips)>0:
+                        ll.tipMap=tips
+                        ll.renameTips(tips)
+                    yield ll
+
+
+def flat_clade_ages(flat, tip_bits):
+    """Clades of one tree in the flat form of `tree.flatten()`, as integer bitsets over a fixed tip order.
+    Bit `tip_bits[numName]` is set for every tip below a node. Nodes with a single child repeat the clade
+    of their child and are reported once, at the oldest of them.
+
+    PARAMS
+    ------
+    flat: dict; flat tree, e.g. from `bt.make_flat_tree(tree_string)`.
+    tip_bits: dict; {numName: bit position} for every tip in the tree.
+
+    RETURNS
+    -------
+    clades: list of (bits, age) tuples, one per distinct clade, in pre-order. The age is the time from the
+    clade's common ancestor to the most recent tip of the tree, i.e. BEAST's node height.
+    """
+    parent = flat['parent']
+    length = flat['length']
+    n = len(parent)
+    depth = [0.0] * n
+    for i in range(1, n):  ## parents come before their children in pre-order
+        depth[i] = depth[parent[i]] + (length[i] or 0.0)
+
+    bits = [0] * n
+    for i, numName in enumerate(flat['numName']):
+        if flat['branchType'][i] == 'leaf':
+            assert numName in tip_bits, 'Tip %s is not in the shared tip order' % (numName)
+            bits[i] = 1 << tip_bits[numName]
+    for i in range(n - 1, 0, -1):  ## children are folded into parents before parents are read
+        bits[parent[i]] |= bits[i]
+
+    tip_depth = max([depth[i] for i in range(n) if flat['branchType'][i] == 'leaf'])
+    clades = []
+    seen = set()
+    for i in range(1, n):  ## position 0 is the placeholder root above the tree string
+        if flat['branchType'][i] == 'node' and bits[i] not in seen:
+            seen.add(bits[i])
+            clades.append((bits[i], tip_depth - depth[i]))
+    return clades
+
+
+_clade_tip_bits = None  ## tip order shared by clade counting worker processes, see _init_clade_worker
+
+
+def _init_clade_worker(tip_bits):
+    global _clade_tip_bits
+    _clade_tip_bits = tip_bits
+
+
+def _tree_string_clades(tree_string):
+    """Clades of a tree string over the worker's tip order; module-level so that a multiprocessing pool can call it."""
+    return flat_clade_ages(bt.make_flat_tree(tree_string), _clade_tip_bits)
+
+
+def iter_tree_clades(tree_path, tips, burnin=0, thin=1, workers=1, chunksize=16,
+                     treestring_regex='tree [A-Za-z\_]+([0-9]+)', verbose=False):
+    """Streams the clades of every tree in a multi-tree NEXUS file (e.g. a BEAST posterior `.trees` file),
+    hashed as integer bitsets over one tip order shared by all trees (see `flat_clade_ages`).
+    Trees are parsed straight into the flat form, without building tree objects. With `workers>1` the
+    parsing and hashing is spread over a process pool, keeping only a bounded batch of trees in flight.
+
+    The tip order follows the translate block, or the tips of the first tree if there is none.
+    Every tree must have the same tips.
+
+    PARAMS
+    ------
+    tree_path: str or open file handle; path to the NEXUS file.
+    tips: dict; filled in-place with the translate block, {numName: name}, as in `iter_nexus_strings`.
+    burnin: int; number of trees at the start of the file to discard.
+    thin: int; keep every `thin`-th tree after the burnin.
+    workers: int; number of worker processes. 1 hashes trees in the calling process.
+    chunksize: int; number of tree strings sent to a worker at a time.
+    treestring_regex: str; regular expression identifying tree lines.
+    verbose: Boolean; verbosity parameter.
+
+    YIELDS
+    ------
+    tip_order, tree_string, clades: list of tip numNames by bit position (the same list for every tree),
+    the tree string, and its list of (bits, age) tuples.
+    """
+    tree_strings = iter_nexus_strings(tree_path, tips, burnin=burnin, thin=thin, treestring_regex=treestring_regex, verbose=verbose)
+    first = next(tree_strings, None)
+    if first is None:
+        return
+    if len(tips) > 0:
+        tip_order = list(tips.keys())
+    else:
+        flat = bt.make_flat_tree(first)
+        tip_order = [numName for numName, branchType in zip(flat['numName'], flat['branchType']) if branchType == 'leaf']
+    tip_bits = {numName: i for i, numName in enumerate(tip_order)}
+    tree_strings = itertools.chain([first], tree_strings)
+
+    if workers == 1:
+        for tree_string in tree_strings:
+            yield tip_order, tree_string, flat_clade_ages(bt.make_flat_tree(tree_string), tip_bits)
+        return
+
+    batch_size = workers * chunksize * 4  ## enough to keep every worker busy without reading the whole file into memory
+    with multiprocessing.Pool(workers, initializer=_init_clade_worker, initargs=(tip_bits,)) as pool:
+        while True:
+            batch = list(itertools.islice(tree_strings, batch_size))
+            if len(batch) == 0:
+                break
+            for tree_string, clades in zip(batch, pool.imap(_tree_string_clades, batch, chunksize)):
+                yield tip_order, tree_string, clades
+
+
+def clade_frequencies(tree_path, burnin=0, thin=1, workers=1, chunksize=16, max_ages=1000, seed=0,
+                      treestring_regex='tree [A-Za-z\_]+([0-9]+)', verbose=False):
+    """Counts how often every clade occurs across the trees of a multi-tree NEXUS file, e.g. a BEAST posterior,
+    and summarises the age of each clade's common ancestor. Trees are streamed (see `iter_tree_clades`), so memory
+    grows with the number of distinct clades rather than the number of trees: ages are kept as running moments
+    plus a uniform random sample of at most `max_ages` values per clade.
+
+    Usage:
+    >>> clades, tip_names = clade_frequencies("posterior.trees", burnin=1000, workers=8)
+    >>> clades[clades.frequency > 0.95]
+
+    PARAMS
+    ------
+    tree_path: str or open file handle; path to the NEXUS file.
+    burnin: int; number of trees at the start of the file to discard.
+    thin: int; keep every `thin`-th tree after the burnin.
+    workers: int; number of worker processes used to parse and hash trees.
+    chunksize: int; number of tree strings sent to a worker at a time.
+    max_ages: int; size of the sample of ages kept for every clade, e.g. for quantiles or HPD intervals.
+    seed: int; random seed for the age samples.
+    treestring_regex: str; regular expression identifying tree lines.
+    verbose: Boolean; verbosity parameter.
+
+    RETURNS
+    -------
+    clades: pandas DataFrame, one row per clade sorted by decreasing frequency, with columns
+        'bits' - the clade as an integer bitset over tip_names,
+        'n_tips' - number of tips in the clade,
+        'count', 'frequency' - number and proportion of trees containing the clade,
+        'age_mean', 'age_sd', 'age_min', 'age_max' - summaries of the clade's age over those trees,
+        'ages' - the sample of ages.
+    tip_names: list of tip names by bit position. Use `clade_tip_names` to decode a clade.
+    """
+    rnd = random.Random(seed)
+    stats = {}  ## bits: [count, mean, sum of squared deviations, min, max, sample of ages]
+    tips = {}
+    tip_order = []
+    n_trees = 0
+    for tip_order, tree_string, clades in iter_tree_clades(tree_path, tips, burnin=burnin, thin=thin, workers=workers, chunksize=chunksize,
+                                                            treestring_regex=treestring_regex, verbose=verbose):
+        n_trees += 1
+        for bits, age in clades:
+            s = stats.get(bits)
+            if s is None:
+                stats[bits] = [1, age, 0.0, age, age, [age]]
+                continue
+            s[0] += 1
+            delta = age - s[1]  ## Welford's running mean and variance
+            s[1] += delta / s[0]
+            s[2] += delta * (age - s[1])
+            s[3] = min(s[3], age)
+            s[4] = max(s[4], age)
+            if len(s[5]) < max_ages:
+                s[5].append(age)
+            else:
+                j = rnd.randrange(s[0])  ## reservoir sampling keeps every age with equal probability
+                if j < max_ages:
+                    s[5][j] = age
+
+    if verbose:
+        print("%d trees, %d distinct clades" % (n_trees, len(stats)))
+    rows = [(bits, bin(bits).count('1'), s[0], s[0] / float(n_trees), s[1], math.sqrt(s[2] / (s[0] - 1)) if s[0] > 1 else 0.0, s[3], s[4], s[5])
+            for bits, s in stats.items()]
+    clades = pd.DataFrame(rows, columns=['bits', 'n_tips', 'count', 'frequency', 'age_mean', 'age_sd', 'age_min', 'age_max', 'ages'])
+    clades = clades.sort_values(['count', 'n_tips'], ascending=[False, False], kind='stable').reset_index(drop=True)
+    return clades, [tips.get(numName, numName) for numName in tip_order]
+
+
+def clade_tip_names(bits, tip_names):
+    """Names of the tips in a clade bitset, e.g. from `clade_frequencies`.
+
+    PARAMS
+    ------
+    bits: int; clade as an integer bitset.
+    tip_names: list of tip names by bit position.
+
+    RETURNS
+    -------
+    names: list of tip names, in bit order.
+    """
+    return [name for i, name in enumerate(tip_names) if (bits >> i) & 1]
+
+
+def mcc_tree(tree_path, clades=None, burnin=0, thin=1, workers=1, chunksize=16,
+             treestring_regex='tree [A-Za-z\_]+([0-9]+)', verbose=False):
+    """Picks the maximum clade credibility (MCC) tree from a multi-tree NEXUS file: the sampled tree whose clades
+    have the highest product of frequencies. Needs the clade frequencies first, so the file is read twice unless
+    `clades` from `clade_frequencies` (with the same burnin and thin) is given; only the best tree string so far is kept.
+    Node heights are those of the sampled tree; each node gets its clade's frequency as trait 'posterior'.
+
+    Usage:
+    >>> clades, tip_names = clade_frequencies("posterior.trees", burnin=1000)
+    >>> ll, log_credibility = mcc_tree("posterior.trees", clades, burnin=1000)
+
+    PARAMS
+    ------
+    tree_path: str; path to the NEXUS file.
+    clades: pandas DataFrame from `clade_frequencies`, or None to compute it here.
+    burnin, thin, workers, chunksize, treestring_regex, verbose: as in `clade_frequencies`.
+
+    RETURNS
+    -------
+    ll: baltic tree object of the MCC tree, traversed, with tips renamed if a translate block was present.
+    log_credibility: float; sum of the log frequencies of the tree's clades.
+    """
+    if clades is None:
+        clades, tip_names = clade_frequencies(tree_path, burnin=burnin, thin=thin, workers=workers, chunksize=chunksize,
+                                              treestring_regex=treestring_regex, verbose=verbose)
+    frequency = dict(zip(clades['bits'].tolist(), clades['frequency'].tolist()))
+
+    tips = {}
+    tip_order = []
+    best_string = None
+    best_score = -np.inf
+    for tip_order, tree_string, tree_clades in iter_tree_clades(tree_path, tips, burnin=burnin, thin=thin, workers=workers, chunksize=chunksize,
+                                                                 treestring_regex=treestring_regex, verbose=verbose):
+        assert all([bits in frequency for bits, age in tree_clades]), 'Clades were counted from a different set of trees'
+        score = sum([math.log(frequency[bits]) for bits, age in tree_clades])
+        if score > best_score:
+            best_string, best_score = tree_string, score
+    assert best_string is not None, 'Regular expression failed to find tree string'
+
+    ll = bt.tree()
+    bt.make_tree(best_string, ll)
+    ll.traverse_tree()
+    if len(tips) > 0:  ## before the index is built, since it is keyed by tip name
+        ll.tipMap = tips
+        ll.renameTips(tips)
+    tip_bits = {numName: i for i, numName in enumerate(tip_order)}
+    index = ll.getLCAIndex()
+    bits = [0] * len(index.order)
+    for i in range(len(index.order) - 1, 0, -1):  ## children are folded into parents before parents are read
+        k = index.order[i]
+        if k.branchType == 'leaf':
+            bits[i] = 1 << tip_bits[k.numName]
+        else:
+            k.traits['posterior'] = frequency[bits[i]]
+        bits[index.position[k.parent]] |= bits[i]
+    return ll, best_score
+
+
+_rf_splits = None  ## bipartitions shared by Robinson-Foulds worker processes, see _init_rf_worker
+_rf_options = None
+
+
+def _init_rf_worker(splits, weighted, normalise):
+    global _rf_splits, _rf_options
+    _rf_splits = splits
+    _rf_options = (weighted, normalise)
+
+
+def split_distances(a, others, weighted=False, normalise=False):
+    """Robinson-Foulds distances from one tree's bipartitions to those of other trees, see `robinson_foulds_matrix`.
+
+    PARAMS
+    ------
+    a: dict; bipartitions of a tree, from `tree.bipartitions()`.
+    others: list of dicts; bipartitions of other trees over the same tip order.
+    weighted, normalise: Boolean; as in `robinson_foulds_matrix`.
+
+    RETURNS
+    -------
+    distances: list of floats, one per entry of `others`.
+    """
+    distances = []
+    for b in others:
+        if weighted:
+            d = sum([abs(a.get(s, 0.0) - b.get(s, 0.0)) for s in a.keys() | b.keys()])
+            total = sum(a.values()) + sum(b.values())
+        else:
+            d = len(a.keys() ^ b.keys())
+            total = len(a) + len(b)
+        if normalise:
+            d = d / float(total) if total > 0 else 0.0
+        distances.append(d)
+    return distances
+
+
+def _rf_row(i):
+    """Distances from tree i to every later tree; module-level so that a multiprocessing pool can call it."""
+    weighted, normalise = _rf_options
+    return i, split_distances(_rf_splits[i], _rf_splits[i + 1:], weighted, normalise)
+
+
+def robinson_foulds_matrix(trees, weighted=False, normalise=False, numName=False, workers=1, chunksize=4):
+    """Pairwise Robinson-Foulds distances between trees over the same tips, e.g. bootstrap replicates or posterior samples.
+    Each tree is reduced once to its bipartitions (see `tree.bipartitions`), integer bitsets over the sorted tip names,
+    and every pair is compared on those. Trees are treated as unrooted.
+
+    Usage:
+    >>> trees = [austechia_read_tree(path) for path in paths]
+    >>> rf = robinson_foulds_matrix(trees, workers=8)
+
+    PARAMS
+    ------
+    trees: list of baltic tree objects, all with the same tips.
+    weighted: Boolean; if True, sum the differences in branch length over all splits, including the branches
+    to single tips, with a split missing from a tree counting as length 0. Otherwise count the splits found
+    in only one of the two trees.
+    normalise: Boolean; divide each distance by the number of splits in both trees (or their total branch length if weighted),
+    giving values between 0 and 1.
+    numName: Boolean; identify tips by numName rather than name. Trees whose tips have no names use numName anyway.
+    workers: int; number of worker processes comparing trees. 1 compares them in the calling process.
+    chunksize: int; number of matrix rows sent to a worker at a time.
+
+    RETURNS
+    -------
+    distances: numpy array of shape (len(trees), len(trees)), symmetric with zeros on the diagonal.
+    """
+    if len(trees) == 0:
+        return np.zeros((0, 0))
+    tip_order = sorted(trees[0].tipNames(numName))
+    splits = [ll.bipartitions(tip_order, numName=numName, trivial=weighted) for ll in trees]
+
+    distances = np.zeros((len(trees), len(trees)))
+    if workers == 1:
+        for i in range(len(trees)):
+            distances[i, i + 1:] = split_distances(splits[i], splits[i + 1:], weighted, normalise)
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_rf_worker, initargs=(splits, weighted, normalise)) as pool:
+            for i, row in pool.imap_unordered(_rf_row, range(len(trees)), chunksize):
+                distances[i, i + 1:] = row
+    distances += distances.T
+    return distances
+
+
 def treesub_to_bt(fn_in, fn_out, verbose=True):
     """
     IMPT NOTE: dm output not working. Parse substitutions.tsv output directly instead
@@ -438,6 +1035,7 @@ def treesub_to_bt(fn_in, fn_out, verbose=True):
 def assign_leaf_trait(tree, dm, query_colname, target_colname, trait_name=""):
     """
     Assigns the values of target_colname to each leaf trait dictionary in the input tree.
+    Wraps assign_leaf_traits() for a single column.
 
     Params
     ------
@@ -454,27 +1052,73 @@ def assign_leaf_trait(tree, dm, query_colname, target_colname, trait_name=""):
     if trait_name == "":
         trait_name = target_colname
 
-    trait_val = "undef"
-    for lf in tree.leaves:
-        d_t = dm.loc[dm[query_colname]==lf.name]
-        if len(d_t) != 1:
-            print("WARNING: %s records found in dataframe for leaf name %s! Will assign 'undef'." % (len(d_t), lf.name))
-        elif len(d_t) == 1:
-            trait_val = list(d_t[target_colname])[0]
-        lf.traits[trait_name] = trait_val
+    return assign_leaf_traits(tree, dm, query_colname, [target_colname], trait_names=[trait_name])
+
+
+def assign_leaf_traits(tree, dm, query_colname, target_colnames, trait_names=None, missing="undef", verbose=True):
+    """
+    Assigns the values of one or many dataframe columns to each leaf trait dictionary in the input tree, with a single
+    indexed join between leaf names and the dataframe. Leaves without exactly one matching record are assigned `missing`;
+    missing and duplicated names are reported once, in aggregate.
+
+    Params
+    ------
+    tree: input Baltic tree
+    dm: pandas dataframe
+    query_colname: str; the column name from which to look up each leaf name.
+    target_colnames: str or list of str; the column names of the traits of interest.
+    trait_names: list of str; the names of the dictionary keys, one per target column. Defaults to `target_colnames`.
+    missing: value assigned to leaves with no record, or more than one.
+    verbose: verbosity parameter.
+
+    Returns
+    -------
+    tree: tree with leaf traits assigned in-place.
+    """
+    if isinstance(target_colnames, str):
+        target_colnames = [target_colnames]
+    if trait_names is None:
+        trait_names = target_colnames
+    assert len(trait_names) == len(target_colnames), "Need one trait name per target column"
+
+    keyed = dm.loc[dm[query_colname].notna()]  # records without a key cannot match any leaf
+    counts = keyed[query_colname].value_counts()
+    duplicated = counts.index[counts > 1]
+    table = keyed.loc[~keyed[query_colname].isin(duplicated)].set_index(query_colname)
+
+    names = [lf.name for lf in tree.leaves]
+    rows = table.index.get_indexer(names).tolist()  # row of each leaf in the table, -1 if absent
+    found = [row >= 0 for row in rows]
+    columns = [table[col].tolist() for col in target_colnames]
+
+    for lf, row in zip(tree.leaves, rows):
+        for trait_name, values in zip(trait_names, columns):
+            lf.traits[trait_name] = values[row] if row >= 0 else missing
+
+    if verbose:
+        duplicated = set(duplicated)
+        dup_names = [nm for nm in names if nm in duplicated]
+        missing_names = [nm for nm, f in zip(names, found) if not f and nm not in duplicated]
+        if len(missing_names) > 0:
+            print("WARNING: %s of %s leaves have no record in the dataframe (e.g. %s)! Assigned '%s'." % (
+                len(missing_names), len(names), missing_names[:3], missing))
+        if len(dup_names) > 0:
+            print("WARNING: %s of %s leaves have more than one record in the dataframe (e.g. %s)! Assigned '%s'." % (
+                len(dup_names), len(names), dup_names[:3], missing))
+        if len(keyed) < len(dm):
+            print("WARNING: %s of %s records in the dataframe have no '%s' and were ignored." % (
+                len(dm) - len(keyed), len(dm), query_colname))
 
     return tree
 
 
 def assign_inode_traits(tree, trait_name):
     """
-    Iterate over all internal nodes, assigning traits to each inode based on their leaves.
-    If all leaves of that node have the same trait, then that inode will have that trait.
-    Otherwise, that node will be assigned 'undef'. Helpful in colouring the branches of monophyletic clades:
-    branch colours are inherited from the trait colour assignment of each parent node. 
-    This code is actually pretty inefficient, because the same node.leaves operation is called for _all_
-    inodes. 
-    
+    Assigns traits to each inode based on their leaves. If all leaves of that node have the same trait, then that inode
+    will have that trait. Otherwise, that node will be assigned 'undef'. Helpful in colouring the branches of monophyletic
+    clades: branch colours are inherited from the trait colour assignment of each parent node.
+    Wraps summarise_inode_traits().
+
     Params
     ------
     tree: Baltic tree with some trait of interest assigned to all leaves.
@@ -483,27 +1127,150 @@ def assign_inode_traits(tree, trait_name):
 
     Returns
     -------
-    tre2: Baltic tree with nodes assigned with traits. 
+    tree: Baltic tree with nodes assigned with traits.
     """
+    return summarise_inode_traits(tree, [trait_name], method="monophyletic")
 
-    inodes_ls = tree.nodes
 
-    inode_trait = "undef" # init
-    for nd in inodes_ls:
-        leaves_ls_temp = nd.leaves # Leaves of the current node
-        lf_traits_ls = []
-        for lf in nd.leaves:
-            lf_traits_ls.append(lf.traits[trait_name])
+def summarise_inode_traits(tree, trait_names, method="monophyletic", undef="undef"):
+    """
+    Summarises leaf traits at every internal node in a single post-order pass, combining the summaries of each node's
+    children rather than looking at all of its leaves.
 
-        if len(np.unique(lf_traits_ls)) == 1:
-            node_trait = np.unique(lf_traits_ls)[0]
-        
-        # write nd.traits in-place, which I hate.
-        nd.traits[trait_name] = node_trait
+    Params
+    ------
+    tree: Baltic tree with the traits of interest assigned to leaves. Leaves without a trait count as `undef`.
+    trait_names: str or list of str; trait names to look up in each leaf.traits dictionary. Each is assigned as a key in
+    each node.traits dictionary.
+    method: str; one of
+        'monophyletic' - the value shared by all of the node's leaves, or `undef` if they differ.
+        'majority' - the most common value among the node's leaves; ties go to the value met first.
+        'counts' - a dictionary of the number of the node's leaves with each value.
+    undef: value assigned to mixed nodes by 'monophyletic'.
+
+    Returns
+    -------
+    tree: Baltic tree with nodes assigned with traits, in-place.
+    """
+    assert method in ["monophyletic", "majority", "counts"], "Unknown method %s" % method
+    if isinstance(trait_names, str):
+        trait_names = [trait_names]
+
+    order = []  # pre-order, root first
+    stack = [tree.root]
+    while len(stack) > 0:
+        k = stack.pop()
+        order.append(k)
+        if k.branchType == "node":
+            stack += k.children[::-1]
+
+    mixed = object()  # children of a monophyletic summary disagree
+    for trait_name in trait_names:
+        summary = {}
+        for k in reversed(order):  # children before parents
+            if k.branchType == "leaf":
+                value = k.traits.get(trait_name, undef)
+                summary[k] = value if method == "monophyletic" else Counter([value])
+                continue
+
+            if method == "monophyletic":
+                values = set([summary.pop(ch) for ch in k.children])
+                summary[k] = values.pop() if len(values) == 1 else mixed
+                if k != tree.root:
+                    k.traits[trait_name] = undef if summary[k] is mixed else summary[k]
+            else:
+                counts = Counter()
+                for ch in k.children:
+                    counts.update(summary.pop(ch))
+                summary[k] = counts
+                if k != tree.root:
+                    k.traits[trait_name] = dict(counts) if method == "counts" else counts.most_common(1)[0][0]
 
     return tree
 
 
+def nearest_reference_labels(tree, ref_names_ls, threshold=None, percentile=None, unassigned="undef", verbose=True):
+    """Labels every non-reference tip of a baltic tree with its nearest reference tip, by tip-to-mrca-to-tip distance.
+    Replaces experimental.get_clade_labels() for baltic trees. Rather than measuring the distance from every tip to every
+    reference, the nearest reference of every branch is found in two passes over the tree: a post-order pass for the nearest
+    reference below each branch, and a pre-order pass that lets branches inherit their parent's nearest reference if it is closer.
+    Ties go to the reference listed first in ref_names_ls. Assumes branch lengths are not negative.
+
+    PARAMS
+    ------
+    tree: baltic tree object, with named tips.
+    ref_names_ls: list of str; reference tip names.
+    threshold: float; tips further than this from their nearest reference are labelled `unassigned`. Off by default.
+    percentile: float between 0 and 100; like threshold, but the cutoff is this percentile of all nearest reference distances.
+    unassigned: label for tips beyond the cutoff.
+    verbose: verbosity parameter.
+
+    RETURNS
+    -------
+    df: pandas dataframe with columns tip_name, clade_label (nearest reference name) and min_dist (distance to it),
+    one row per non-reference tip in pre-order.
+    """
+    t0 = time.time()
+
+    order = []  # pre-order, root first
+    stack = [tree.root]
+    while len(stack) > 0:
+        k = stack.pop()
+        order.append(k)
+        if k.branchType == "node":
+            stack += k.children[::-1]
+    position = {k: i for i, k in enumerate(order)}
+
+    ref_rank = {nm: i for i, nm in enumerate(ref_names_ls)}
+    names_set = set([k.name for k in order if k.branchType == "leaf"])
+    for ref_nm in ref_names_ls:
+        if ref_nm not in names_set:
+            print("WARNING: %s not found in input tree!" % ref_nm)
+
+    # Nearest reference below each branch, as (distance, reference rank)
+    no_ref = (float("inf"), len(ref_names_ls))
+    best = [no_ref] * len(order)
+    for i in range(len(order) - 1, -1, -1):
+        k = order[i]
+        if k.branchType == "leaf":
+            if k.name in ref_rank:
+                best[i] = (0.0, ref_rank[k.name])
+        else:
+            for ch in k.children:
+                dist, rank = best[position[ch]]
+                length = ch.length or 0.0  # tips and branches without a length in the tree string
+                if (dist + length, rank) < best[i]:
+                    best[i] = (dist + length, rank)
+
+    # Nearest reference anywhere, passed down from parents
+    for i in range(1, len(order)):
+        k = order[i]
+        dist, rank = best[position[k.parent]]
+        length = k.length or 0.0
+        if (dist + length, rank) < best[i]:
+            best[i] = (dist + length, rank)
+
+    contents = [[k.name, ref_names_ls[best[i][1]] if best[i][1] < len(ref_names_ls) else unassigned, best[i][0]]
+                for i, k in enumerate(order) if k.branchType == "leaf" and k.name not in ref_rank]
+    df = pd.DataFrame(data=contents, columns=["tip_name", "clade_label", "min_dist"])
+
+    if verbose:
+        print("No. of reference tip names = %s" % len(ref_names_ls))
+        print("No. of non-reference tip names = %s" % len(df))
+
+    if percentile is not None:
+        threshold = np.percentile(df["min_dist"], percentile)
+    if threshold is not None:
+        df.loc[df["min_dist"] > threshold, "clade_label"] = unassigned
+        if verbose:
+            print("%s tips further than %s from any reference" % ((df["min_dist"] > threshold).sum(), threshold))
+
+    if verbose:
+        print("Done in %.2fs" % (time.time() - t0))
+
+    return df
+
+
 def brew_colour_dictionary(my_list, scheme="qualitative", style="paired"):
     """Create a colour dictionary based on colorbrew presets.
     
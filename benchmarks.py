@@ -0,0 +1,140 @@
+"""Benchmarks for the tree methods in baltic3.py that have to scale to large trees.
+Run all of them with `python benchmarks.py`.
+"""
+
+import os
+import random
+import time
+import tracemalloc
+
+import baltic3 as bt
+import baltic3_utils as btu
+
+
+def random_tree_string(n_tips, seed=0):
+    """Builds a random bifurcating newick string by joining random pairs of subtrees,
+    which gives coalescent-like trees of logarithmic depth.
+
+    PARAMS
+    ------
+    n_tips: int; number of tips.
+    seed: int; random seed.
+
+    RETURNS
+    -------
+    tree_string: str; newick string, ending with ';'.
+    """
+    rnd = random.Random(seed)
+    subtrees = ["tip%d:%.5f" % (i, rnd.random()) for i in range(n_tips)]
+    while len(subtrees) > 1:
+        i = rnd.randrange(len(subtrees))
+        subtrees[i], subtrees[-1] = subtrees[-1], subtrees[i]
+        a = subtrees.pop()
+        j = rnd.randrange(len(subtrees))
+        subtrees[j] = "(%s,%s):%.5f" % (a, subtrees[j], rnd.random())
+    return subtrees[0][:subtrees[0].rindex(":")] + ";"
+
+
+def random_tree(n_tips, seed=0):
+    """Parses `random_tree_string(n_tips, seed)` into a baltic tree object (not yet traversed)."""
+    ll = bt.tree()
+    bt.make_tree(random_tree_string(n_tips, seed), ll)
+    return ll
+
+
+def benchmark_traverse_tree(sizes=(1000, 10000, 100000), seed=0, verbose=True):
+    """Times `tree.traverse_tree()` on random trees of increasing size.
+    Time per tip should stay roughly flat as the number of tips grows.
+
+    RETURNS
+    -------
+    timings: list of (n_tips, seconds) tuples.
+    """
+    timings = []
+    for n in sizes:
+        ll = random_tree(n, seed)
+        t0 = time.perf_counter()
+        ll.traverse_tree()
+        elapsed = time.perf_counter() - t0
+        timings.append((n, elapsed))
+        if verbose:
+            print("traverse_tree: %7d tips in %.3fs (%.2f us/tip)" % (n, elapsed, elapsed / n * 1e6))
+    return timings
+
+
+def benchmark_sortBranches(sizes=(1000, 10000, 100000), seed=0, verbose=True):
+    """Times `tree.sortBranches()`, which sorts children and then lays the tree out with `drawTree()`,
+    on random trees of increasing size.
+
+    RETURNS
+    -------
+    timings: list of (n_tips, seconds) tuples.
+    """
+    timings = []
+    for n in sizes:
+        ll = random_tree(n, seed)
+        ll.traverse_tree()
+        t0 = time.perf_counter()
+        ll.sortBranches()
+        elapsed = time.perf_counter() - t0
+        timings.append((n, elapsed))
+        if verbose:
+            print("sortBranches: %7d tips in %.3fs (%.2f us/tip)" % (n, elapsed, elapsed / n * 1e6))
+    return timings
+
+
+def benchmark_edits(n_tips=50000, n_edits=20, seed=0, verbose=True):
+    """Times collapsing subtrees of a sorted random tree one at a time, reading `ySpan` after each
+    collapse so that heights, sort order and coordinates are brought up to date every time (see `tree.update()`).
+    Time per edit should be far below the time of a full `traverse_tree()` and `sortBranches()`.
+
+    RETURNS
+    -------
+    per_edit, full: floats; seconds per collapse, and seconds for one full traversal and sort of the same tree.
+    """
+    ll = random_tree(n_tips, seed)
+    ll.traverse_tree()
+    ll.sortBranches()
+    ll.setAbsoluteTime(2020.0)
+    candidates = [k for k in ll.nodes if 5 < k.numChildren < 50]
+    chosen = random.Random(seed).sample(candidates, n_edits)
+    chosen = [k for k in chosen if not any(set(k.leaves) & set(q.leaves) for q in chosen if q is not k)]
+    t0 = time.perf_counter()
+    for i, k in enumerate(chosen):
+        ll.collapseSubtree(k, "clade%d" % i)
+        ll.ySpan
+    per_edit = (time.perf_counter() - t0) / len(chosen)
+    t0 = time.perf_counter()
+    ll.traverse_tree()
+    ll.sortBranches()
+    full = time.perf_counter() - t0
+    if verbose:
+        print("collapseSubtree: %7d tips, %.4fs per edit (full traverse_tree and sortBranches %.3fs)" % (n_tips, per_edit, full))
+    return per_edit, full
+
+
+def benchmark_memory(tree_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "tutorials", "zikv_ft.nex"), verbose=True):
+    """Measures memory allocated while loading a NEXUS tree with `loadNexus`, using tracemalloc.
+
+    PARAMS
+    ------
+    tree_path: str; path to the NEXUS file. Defaults to the Zika tree in tutorials/.
+
+    RETURNS
+    -------
+    retained, peak: ints; bytes still held by the loaded tree, and the peak during loading.
+    """
+    tracemalloc.start()
+    ll = btu.loadNexus(tree_path, absoluteTime=False)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if verbose:
+        print("loadNexus: %d objects, %.2f MB retained, %.2f MB peak" % (len(ll.Objects), retained / 1e6, peak / 1e6))
+    return retained, peak
+
+
+if __name__ == '__main__':
+    benchmark_traverse_tree()
+    benchmark_sortBranches()
+    benchmark_edits()
+    benchmark_memory()
@@ -5,6 +5,9 @@ import itertools
 
 from Bio import Phylo
 
+import baltic3 as bt
+import baltic3_utils as btu
+
 """
 A bunch of cookbook or wrapper functions related to Bio.Phylo. Not strictly
 related to baltic3, but I'm putting them here for git saving convenience.
@@ -97,7 +100,8 @@ def genetic_distance_matrix(my_tree, names_ls):
 
     PARAMS
     ------
-    my_tree: Bio.Phylo tree object
+    my_tree: Bio.Phylo tree object, or a traversed baltic tree object. Baltic
+    trees are handled by tree.patristicMatrix(), without per-pair tree walks.
     names_ls: list of str. List of tipnames to compute genetic distance with,
     using branch lengths as a measure.
 
@@ -105,6 +109,9 @@ def genetic_distance_matrix(my_tree, names_ls):
     -------
     hm_data: np array of shape (len(names_ls), len(names_ls)), type float.
     """
+    if isinstance(my_tree, bt.tree):
+        return np.triu(my_tree.patristicMatrix(names_ls), k=1)
+
     all_pairs = list(itertools.combinations((names_ls), 2))
     gd_ls = []
     n_seq = len(names_ls)
@@ -124,15 +131,18 @@ def genetic_distance_matrix(my_tree, names_ls):
     return hm_data
 
 
-def get_clade_labels(my_tree, ref_names_ls, verbose=True):
+def get_clade_labels(my_tree, ref_names_ls, threshold=None, percentile=None, unassigned="undef", verbose=True):
     """Computes tip-to-tmrc-to-tip distances for each tipname in my_tree, to
     each reference name in ref_names_ls. my_tree must contain the reference
     names in ref_names_ls.
 
     PARAMS
     ------
-    my_tree: a tree file, readable by Bio.Phylo.
+    my_tree: a tree file, readable by Bio.Phylo, or a baltic tree object.
     ref_names_ls: a list of reference tip names.
+    threshold: float; tips further than this from their nearest reference are labelled `unassigned`. Off by default.
+    percentile: float between 0 and 100; like threshold, but the cutoff is this percentile of all nearest reference distances.
+    unassigned: label for tips beyond the cutoff.
     verbose: verbosity parameter.
 
     RETURNS
@@ -140,8 +150,14 @@ def get_clade_labels(my_tree, ref_names_ls, verbose=True):
     df: pandas dataframe with columns: tip_names, their distance to every given
     reference name, the nearest reference distance, and nearest reference label.
 
-    TODO: implement thresholding by percentile.
+    Baltic tree objects are handed to baltic3_utils.nearest_reference_labels(),
+    which finds nearest references in two tree passes and returns only the
+    tip_name, clade_label and min_dist columns.
     """
+    if isinstance(my_tree, bt.tree):
+        return btu.nearest_reference_labels(my_tree, ref_names_ls, threshold=threshold, percentile=percentile,
+                                            unassigned=unassigned, verbose=verbose)
+
     t0 = time.time()
 
     # Get all tipnames
@@ -184,4 +200,9 @@ def get_clade_labels(my_tree, ref_names_ls, verbose=True):
     df["clade_label"] = df.apply(lambda row: str(row["clade_label"]).replace("dist_to_", ""), axis=1)
     df["min_dist"] = df.loc[:, df_cols].min(axis=1)
 
+    if percentile is not None:
+        threshold = np.percentile(df["min_dist"], percentile)
+    if threshold is not None:
+        df.loc[df["min_dist"] > threshold, "clade_label"] = unassigned
+
     return df
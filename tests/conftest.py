@@ -0,0 +1,52 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import baltic3 as bt  # noqa: E402
+
+ZIKA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tutorials", "zikv_ft.nex")
+
+
+def random_tree_string(n_tips, seed=0, prefix="tip"):
+    """Random bifurcating newick string with tips named `prefix` followed by a number, as in benchmarks.py."""
+    rnd = random.Random(seed)
+    subtrees = ["%s%d:%.5f" % (prefix, i, rnd.random()) for i in range(n_tips)]
+    while len(subtrees) > 1:
+        i = rnd.randrange(len(subtrees))
+        subtrees[i], subtrees[-1] = subtrees[-1], subtrees[i]
+        a = subtrees.pop()
+        j = rnd.randrange(len(subtrees))
+        subtrees[j] = "(%s,%s):%.5f" % (a, subtrees[j], rnd.random())
+    return subtrees[0][:subtrees[0].rindex(":")] + ";"
+
+
+def named_tree(tree_string):
+    """Parses, traverses and sorts a tree, with tip names set to their numNames."""
+    ll = bt.tree()
+    bt.make_tree(tree_string, ll)
+    ll.traverse_tree()
+    ll.renameTips({k.numName: k.numName for k in ll.leaves})
+    ll.sortBranches()
+    return ll
+
+
+@pytest.fixture
+def posterior_path(tmp_path):
+    """A small BEAST-like posterior file: 40 trees over 20 tips, numbered through a translate block."""
+    lines = ["#NEXUS", "Begin taxa;", "\tDimensions ntax=20;", "End;", "Begin trees;", "\tTranslate"]
+    for i in range(20):
+        lines.append("\t\t%d tip_%d%s" % (i + 1, i, "," if i < 19 else ""))
+    lines.append(";")
+    for t in range(40):
+        tree_string = random_tree_string(20, seed=t % 5, prefix="T")
+        for i in range(19, -1, -1):
+            tree_string = tree_string.replace("T%d:" % i, "%d:" % (i + 1))
+        lines.append("tree STATE_%d = [&R] %s" % (t, tree_string))
+    lines.append("End;")
+    path = tmp_path / "posterior.trees"
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
@@ -0,0 +1,103 @@
+import os
+import shutil
+
+import pytest
+
+import baltic3 as bt
+import baltic3_utils as btu
+from conftest import ZIKA_PATH, random_tree_string
+from test_parsing import annotated_tree_string
+
+
+def state(ll):
+    """Branches sorted by index, with everything save_binary writes, and the tree-wide values."""
+    rows = []
+    for k in [ll.root] + ll.Objects:
+        rows.append((str(k.index), k.branchType, k.length, k.height, k.absoluteTime, getattr(k, "numName", None),
+                     getattr(k, "name", None), k.traits, k.x, k.y, getattr(k.parent, "index", None),
+                     [c.index for c in getattr(k, "children", [])]))
+    return sorted(rows), ll.treeHeight, ll.tipMap
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_save_load_round_trip(tmp_path, seed):
+    ll = bt.tree()
+    bt.make_tree(annotated_tree_string(150, seed), ll)
+    path = str(tmp_path / "tree.bin")
+    ll.save_binary(path)
+    assert state(bt.load_binary(path)) == state(ll)
+
+    ll.traverse_tree()
+    ll.sortBranches()
+    ll.save_binary(path, source={"seed": seed})
+    loaded = bt.load_binary(path)
+    assert state(loaded) == state(ll)
+    assert bt.load_binary_header(path)["source"] == {"seed": seed}
+    loaded.traverse_tree()
+    loaded.sortBranches()
+    assert [k.index for k in bt._preorder(loaded.root)] == [k.index for k in bt._preorder(ll.root)]
+
+
+def test_save_load_arrays(tmp_path):
+    tree_string = random_tree_string(300, 2)
+    at = bt.make_array_tree(tree_string)
+    at.sortBranches()
+    path = str(tmp_path / "tree.bin")
+    at.save_binary(path)
+    loaded = bt.load_binary(path, arrays=True)
+    assert loaded.flatten() == at.flatten()
+    objects = bt.load_binary(path)
+    assert [traits or {} for traits in objects.flatten()["traits"]] == [traits or {} for traits in at.flatten()["traits"]]
+    assert {key: value for key, value in objects.flatten().items() if key != "traits"} == \
+        {key: value for key, value in at.flatten().items() if key != "traits"}
+
+
+def test_load_binary_rejects_other_files(tmp_path):
+    path = tmp_path / "tree.bin"
+    path.write_bytes(b"not a tree")
+    assert bt.load_binary_header(str(path)) is None
+
+
+def test_save_collapsed_tree_raises(tmp_path):
+    ll = bt.tree()
+    bt.make_tree(random_tree_string(30, 1), ll)
+    ll.traverse_tree()
+    ll.setAbsoluteTime(2020.0)
+    ll.collapseSubtree([k for k in ll.nodes if k.parent is not ll.root and len(k.leaves) > 2][0], "clade")
+    with pytest.raises(ValueError):
+        ll.save_binary(str(tmp_path / "tree.bin"))
+
+
+@pytest.fixture
+def zika_path(tmp_path):
+    path = str(tmp_path / "zikv_ft.nex")
+    shutil.copy(ZIKA_PATH, path)
+    return path
+
+
+def test_load_nexus_cache(zika_path):
+    parsed = btu.loadNexus(zika_path, absoluteTime=False)
+    written = btu.loadNexus(zika_path, absoluteTime=False, cache=True)
+    assert os.path.exists(zika_path + ".baltic")
+    cached = btu.loadNexus(zika_path, absoluteTime=False, cache=True)
+    assert state(written) == state(parsed)
+    assert state(cached) == state(parsed)
+    assert cached.commonAncestor([k.name for k in parsed.leaves[:5]]).index == \
+        parsed.commonAncestor([k.name for k in parsed.leaves[:5]]).index
+
+    with open(zika_path, "a") as handle:  # a changed file is parsed again
+        handle.write("\n")
+    os.utime(zika_path, ns=(0, 0))
+    assert bt.load_binary_header(zika_path + ".baltic")["source"]["mtime_ns"] != 0
+    btu.loadNexus(zika_path, absoluteTime=False, cache=True)
+    assert bt.load_binary_header(zika_path + ".baltic")["source"]["mtime_ns"] == 0
+
+
+def test_load_nexus_cache_not_writable(zika_path, monkeypatch, capsys):
+    def fail(self, path, source=None):
+        raise OSError("read-only file system")
+    monkeypatch.setattr(bt.tree, "save_binary", fail)
+    ll = btu.loadNexus(zika_path, absoluteTime=False, cache=True)
+    assert len(ll.leaves) > 0
+    assert not os.path.exists(zika_path + ".baltic")
+    assert "WARNING" in capsys.readouterr().out
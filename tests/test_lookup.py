@@ -0,0 +1,147 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+import baltic3 as bt
+import baltic3_utils as btu
+from conftest import named_tree, random_tree_string
+
+
+def ancestors(k):
+    path = []
+    while k is not None:
+        path.append(k)
+        k = k.parent
+    return path
+
+
+def naive_common_ancestor(ll, tips):
+    """Deepest branch on every tip's path to the root, or the parent of a single tip."""
+    shared = set(ancestors(tips[0]))
+    for k in tips[1:]:
+        shared &= set(ancestors(k))
+    ancestor = [k for k in ancestors(tips[0]) if k in shared][0]
+    return ancestor.parent if ancestor.branchType == "leaf" else ancestor
+
+
+def subtree_tips(k):
+    return [w for w in bt._preorder(k) if w.branchType != "node"]
+
+
+def assert_lookups(ll):
+    """Lookups, tipsOf, isDescendant and commonAncestor agree with walks over the tree as it now is."""
+    rnd = random.Random(len(ll.Objects))
+    tips = [k for k in ll.Objects if k.branchType != "node"]
+    for k in tips:
+        assert ll.leaf_by_name(k.name) is k
+        assert ll.leaf_by_name(k.numName, numName=True) is k
+    for k in ll.Objects:
+        assert ll.branch_by_index(k.index) is k
+    assert ll.branch_by_index(ll.root.index) is ll.root
+    for k in rnd.sample(ll.nodes, min(20, len(ll.nodes))):
+        assert ll.tipsOf(k) == subtree_tips(k)
+        for w in rnd.sample(ll.Objects, 5):
+            assert ll.isDescendant(w, k) == (k in ancestors(w))
+    for n in [1, 2, 3, 10]:
+        for _ in range(10):
+            chosen = rnd.sample(tips, min(n, len(tips)))
+            assert ll.commonAncestor([k.name for k in chosen]) is naive_common_ancestor(ll, chosen)
+
+
+@pytest.fixture
+def tree():
+    ll = named_tree(random_tree_string(120, 3))
+    ll.setAbsoluteTime(2020.0)
+    return ll
+
+
+def test_lookups(tree):
+    assert_lookups(tree)
+    assert tree.leaf_by_name("no such tip") is None
+    assert tree.branch_by_index(-1) is None
+    assert btu.get_leaf(tree, tree.leaves[0].name) is tree.leaves[0]
+
+
+def test_lookups_after_collapse(tree):
+    assert_lookups(tree)  # lookups exist before the tree changes
+    cl = [k for k in tree.nodes if k.parent is not tree.root and 5 < len(k.leaves) < 30][0]
+    hidden = [k for k in bt._preorder(cl) if k.branchType == "leaf"]
+    index = cl.index
+    tree.collapseSubtree(cl, "collapsed")
+    collapsed = tree.leaf_by_name("collapsed")
+    assert isinstance(collapsed, bt.clade)
+    assert tree.branch_by_index(index) is collapsed
+    assert all([tree.leaf_by_name(k.name) is None for k in hidden])
+    assert_lookups(tree)
+
+    tree.uncollapseSubtree()
+    assert tree.leaf_by_name("collapsed") is None
+    assert all([tree.leaf_by_name(k.name) is k for k in hidden])
+    assert_lookups(tree)
+
+
+def test_lookups_after_reduce(tree):
+    assert_lookups(tree)
+    keep = random.Random(0).sample(tree.leaves, 30)
+    reduced = tree.reduceTree(keep)
+    assert sorted([k.name for k in reduced.leaves]) == sorted([k.name for k in keep])
+    assert_lookups(reduced)
+    assert_lookups(tree)
+
+
+def test_lookups_after_subtree(tree):
+    k = [k for k in tree.nodes if k.parent is not tree.root and len(k.leaves) > 20][0]
+    names = sorted([w.name for w in bt._preorder(k) if w.branchType == "leaf"])
+    sub = tree.subtree(k)
+    assert sorted([w.name for w in sub.leaves]) == names
+    assert_lookups(sub)
+
+
+def test_lookups_after_rename(tree):
+    assert_lookups(tree)
+    old = [k.name for k in tree.leaves[:5]]
+    ancestor = tree.commonAncestor(old)
+    tree.renameTips({k.numName: "renamed_%s" % k.numName for k in tree.leaves})
+    assert all([tree.leaf_by_name(name) is None for name in old])
+    assert tree.commonAncestor(["renamed_%s" % name for name in old]) is ancestor
+    assert_lookups(tree)
+
+
+def brute_force_splits(ll, tip_order, trivial=False):
+    """Bipartitions from the tip sets of every branch, the root's two sides merged."""
+    everything = frozenset(tip_order)
+    splits = {}
+    for k in ll.Objects:
+        side = frozenset([w.name for w in bt._preorder(k) if w.branchType == "leaf"])
+        if tip_order[0] in side:
+            side = everything - side
+        if len(side) == 0 or (not trivial and len(side) in (1, len(everything) - 1)):
+            continue
+        splits[side] = splits.get(side, 0.0) + k.length
+    return splits
+
+
+def test_bipartitions():
+    ll = named_tree(random_tree_string(40, 4))
+    tip_order = sorted(ll.tipNames())
+    for trivial in [False, True]:
+        splits = ll.bipartitions(trivial=trivial)
+        found = {frozenset(btu.clade_tip_names(bits, tip_order)): length for bits, length in splits.items()}
+        expected = brute_force_splits(ll, tip_order, trivial)
+        assert found.keys() == expected.keys()
+        assert all([found[s] == pytest.approx(expected[s]) for s in expected])
+
+
+def test_robinson_foulds_matrix():
+    trees = [named_tree(random_tree_string(25, seed)) for seed in range(5)]
+    tip_order = sorted(trees[0].tipNames())
+    splits = [set(brute_force_splits(ll, tip_order)) for ll in trees]
+    rf = btu.robinson_foulds_matrix(trees)
+    for i, j in itertools.product(range(len(trees)), repeat=2):
+        assert rf[i, j] == len(splits[i] ^ splits[j])
+    assert np.array_equal(rf, btu.robinson_foulds_matrix(trees, workers=2, chunksize=1))
+    normalised = btu.robinson_foulds_matrix(trees, normalise=True)
+    assert normalised.max() <= 1.0
+    assert btu.robinson_foulds_matrix(trees[:1] * 2, weighted=True)[0, 1] == 0.0
@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+import baltic3 as bt
+from conftest import ZIKA_PATH, random_tree_string
+
+
+def annotated_tree_string(n_tips, seed=0):
+    """Random newick string with BEAST-style comments, node labels, quoted names and single-child nodes."""
+    rnd = random.Random(seed)
+    subtrees = []
+    for i in range(n_tips):
+        s = "'tip_%d|x-%d'" % (i, rnd.randint(0, 99)) if i % 2 == 0 else "%d" % (i + 1)
+        if rnd.random() < 0.5:
+            s += '[&rate=%s,host="h%d",height_95%%_HPD={0.1,0.2}]' % (rnd.random(), rnd.randint(0, 3))
+        subtrees.append(s + ":%s" % (rnd.choice(["%.6f", "%.3E"]) % rnd.random()))
+    while len(subtrees) > 1:
+        kids = [subtrees.pop(rnd.randrange(len(subtrees))) for _ in range(min(rnd.choice([2, 2, 3]), len(subtrees)))]
+        s = "(" + ",".join(kids) + ")"
+        if rnd.random() < 0.2:
+            s = "(%s:0.01)%d[&type=\"A\"]" % (s, rnd.randint(1, 9))
+        if rnd.random() < 0.3:
+            s += str(rnd.randint(0, 100))
+        if rnd.random() < 0.5:
+            s += '[&posterior=%s,host="h%d"]' % (rnd.random(), rnd.randint(0, 3))
+        subtrees.append(s + ":%.5f" % rnd.random())
+    return subtrees[0][:subtrees[0].rindex(":")] + ";"
+
+
+def zika_tree_string():
+    with open(ZIKA_PATH) as handle:
+        for line in handle:
+            if line.strip().startswith("tree "):
+                return line[line.index("("):].strip()
+
+
+def parsed(tree_string, legacy):
+    ll = bt.tree()
+    if legacy:
+        bt.make_tree_legacy(tree_string, ll)
+    else:
+        bt.make_tree(tree_string, ll)
+    return ll
+
+
+def structure(ll):
+    """Branches in pre-order with everything the parser sets on them."""
+    out = []
+    for k in bt._preorder(ll.root):
+        traits = {key: list(value) if isinstance(value, (list, tuple)) else value for key, value in k.traits.items()}
+        out.append((k.branchType, k.index, getattr(k, "numName", None), k.length, traits,
+                    getattr(k.parent, "index", None), [c.index for c in getattr(k, "children", [])]))
+    return out
+
+
+def without_empty_traits(flat):
+    """Flat trees built without objects leave empty traits as None."""
+    return dict(flat, traits=[traits or {} for traits in flat["traits"]])
+
+
+TREE_STRINGS = ["(A,B);", "(A:1,(B:2,C:3)90:1);", "((A:1,B:1)0.95:1,C:2)1.0;", "(1:0.1,2:0.2)[&x=1];"]
+
+
+@pytest.mark.parametrize("tree_string", TREE_STRINGS + [random_tree_string(200, seed) for seed in range(3)]
+                         + [annotated_tree_string(60 + seed, seed) for seed in range(10)])
+def test_make_tree_matches_legacy(tree_string):
+    assert structure(parsed(tree_string, False)) == structure(parsed(tree_string, True))
+
+
+def test_make_tree_matches_legacy_zika():
+    tree_string = zika_tree_string()
+    assert structure(parsed(tree_string, False)) == structure(parsed(tree_string, True))
+
+
+def test_make_tree_legacy_flag():
+    tree_string = annotated_tree_string(40, 1)
+    ll = bt.tree()
+    bt.make_tree(tree_string, ll, legacy=True)
+    assert structure(ll) == structure(parsed(tree_string, True))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_flatten_round_trip(seed):
+    ll = parsed(annotated_tree_string(80, seed), False)
+    ll.traverse_tree()
+    ll.sortBranches()
+    copy = bt.unflatten(ll.flatten())
+    assert structure(copy) == structure(ll)
+    assert sorted([k.index for k in copy.leaves]) == sorted([k.index for k in ll.leaves])
+    assert copy.treeHeight == pytest.approx(ll.treeHeight)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_flat_and_array_trees_match_objects(seed):
+    tree_string = random_tree_string(150, seed)
+    ll = parsed(tree_string, False)
+    assert without_empty_traits(bt.make_flat_tree(tree_string)) == without_empty_traits(ll.flatten())
+    ll.traverse_tree()
+    assert without_empty_traits(bt.make_array_tree(tree_string).flatten()) == without_empty_traits(ll.flatten())
+    assert structure(bt.make_array_tree(tree_string).toTree()) == structure(ll)
@@ -0,0 +1,35 @@
+import math
+from collections import Counter
+
+import baltic3_utils as btu
+
+
+def test_clade_frequencies_match_tree_objects(posterior_path):
+    clades, tip_names = btu.clade_frequencies(posterior_path, burnin=5)
+    counts = Counter()
+    n_trees = 0
+    for ll in btu.iter_nexus_trees(posterior_path, burnin=5):
+        n_trees += 1
+        counts.update(set([frozenset([w.name for w in ll.tipsOf(k)]) for k in ll.nodes]))
+    found = {frozenset(btu.clade_tip_names(bits, tip_names)): count for bits, count in zip(clades["bits"], clades["count"])}
+    assert found == dict(counts)
+    assert math.isclose(clades["frequency"].max(), 1.0)
+    assert clades["count"].max() == n_trees
+
+
+def test_clade_frequencies_workers(posterior_path):
+    clades, tip_names = btu.clade_frequencies(posterior_path, burnin=5)
+    parallel, parallel_names = btu.clade_frequencies(posterior_path, burnin=5, workers=2, chunksize=3)
+    assert tip_names == parallel_names
+    assert clades.drop(columns="ages").equals(parallel.drop(columns="ages"))
+
+
+def test_mcc_tree_is_named_and_indexed(posterior_path):
+    clades, tip_names = btu.clade_frequencies(posterior_path, burnin=5)
+    ll, log_credibility = btu.mcc_tree(posterior_path, clades, burnin=5)
+    assert sorted([k.name for k in ll.leaves]) == sorted(tip_names)
+    ancestor = ll.commonAncestor(["tip_0", "tip_1"])
+    assert set(["tip_0", "tip_1"]) <= set([k.name for k in ll.tipsOf(ancestor)])
+    assert 0.0 < ancestor.traits["posterior"] <= 1.0
+    assert ll.leaf_by_name("tip_0").name == "tip_0"
+    assert log_credibility <= 0.0
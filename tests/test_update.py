@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+import baltic3 as bt
+
+
+def rounded(x):
+    if isinstance(x, float):
+        return round(x, 9) + 0.0
+    if isinstance(x, (list, tuple)):
+        return [rounded(v) for v in x]
+    if isinstance(x, dict):
+        return {key: rounded(value) for key, value in x.items()}
+    return x
+
+
+def multifurcating_tree_string(n_tips, rnd):
+    """Random newick string with polytomies, single-child nodes and zero-length branches."""
+    subtrees = ["t%d:%.3f" % (i, rnd.random()) for i in range(n_tips)]
+    while len(subtrees) > 1:
+        kids = [subtrees.pop(rnd.randrange(len(subtrees))) for _ in range(min(rnd.choice([2, 2, 2, 3]), len(subtrees)))]
+        s = "(%s)" % (",".join(kids))
+        if rnd.random() < 0.3:
+            s = "(%s:%.3f)" % (s, rnd.random())
+        subtrees.append(s + ":%s" % rnd.choice(["0.0", "%.3f" % rnd.random()]))
+    return subtrees[0][:subtrees[0].rindex(":")] + ";"
+
+
+def snapshot(ll):
+    """Everything traverse_tree, sortBranches and drawTree set, in the order of the tree's Objects."""
+    rows = []
+    for k in ll.Objects:
+        row = [k.branchType, k.index, getattr(k, "numName", None), getattr(k, "name", None), k.length, k.height,
+               sorted(k.traits.items()), getattr(k.parent, "index", None), k.x, k.y, k.absoluteTime]
+        if k.branchType == "node":
+            row += [[c.index for c in k.children], list(k.leaves), k.numChildren, k.childHeight]
+        rows.append(row)
+    return rounded([rows, ll.treeHeight, ll.ySpan, [k.index for k in ll.leaves], [k.index for k in ll.nodes]])
+
+
+def assert_up_to_date(ll):
+    """Compares the tree as brought up to date incrementally with a full traversal (and sort) of the same tree."""
+    incremental = snapshot(ll)
+    sorting = ll.sorting
+    ll.traverse_tree()
+    if sorting is not None:
+        ll.sortBranches(sorting)
+    assert incremental == snapshot(ll)
+
+
+def non_overlapping_nodes(ll, rnd, n):
+    candidates = [k for k in ll.nodes if k.parent is not ll.root and len(k.leaves) < len(ll.leaves) - 1]
+    chosen = []
+    for k in rnd.sample(candidates, min(n, len(candidates))):
+        if any([ll.isDescendant(k, c) or ll.isDescendant(c, k) for c in chosen]):
+            continue
+        chosen.append(k)
+    return chosen
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_incremental_update_matches_traversal(seed):
+    rnd = random.Random(seed)
+    ll = bt.tree()
+    bt.make_tree(multifurcating_tree_string(rnd.randint(5, 200), rnd), ll)
+    ll.traverse_tree()
+    if rnd.random() < 0.7:
+        ll.sortBranches(rnd.choice([True, False]))
+    ll.setAbsoluteTime(2020.0)  # collapsed clades take their last absolute time from the subtree
+    for step in range(6):
+        edit = rnd.choice(["collapse", "collapse", "uncollapse", "single", "length"])
+        if edit == "collapse":
+            chosen = non_overlapping_nodes(ll, rnd, 3)
+            ll.collapse_many(chosen, ["c%d_%d" % (step, i) for i in range(len(chosen))])
+        elif edit == "uncollapse":
+            ll.uncollapseSubtree()
+        elif edit == "single":
+            ll.singleType()
+        else:
+            k = rnd.choice(ll.Objects)
+            k.length = rnd.random()
+            ll.markDirty(k)
+        if rnd.random() < 0.5:
+            assert_up_to_date(ll)
+    assert_up_to_date(ll)
+
+
+def test_reduced_tree_matches_traversal():
+    rnd = random.Random(1)
+    ll = bt.tree()
+    bt.make_tree(multifurcating_tree_string(150, rnd), ll)
+    ll.traverse_tree()
+    ll.sortBranches()
+    reduced = ll.reduceTree(rnd.sample(ll.leaves, 40))
+    assert len(reduced.leaves) == 40
+    assert_up_to_date(reduced)